@@ -9,6 +9,17 @@ SRC_PATH = os.path.split(os.path.abspath(__file__))[0]
 ES_HOST = 'localhost:9200'
 ES_INDEX_NAME = 'myvariant_current'
 ES_DOC_TYPE = 'variant'
+# route docs to shards by chromosome (derived from the HGVS _id) instead of
+# by _id, so that a region query or a single get only hits one shard.
+# Must be the same when the index is built and when it's queried.
+ES_ROUTING_BY_CHROM = False
+
+# Bloom filter of all ids in the index, built after each index build
+# (ESIndexer.build_id_filter) and read by the web nodes to answer unknown
+# ids without an ES request. Disabled if not set. When set, ESIndexer
+# writes first mark the index _meta as updated, see ESIndexer.mark_updated.
+#ID_FILTER_PATH = os.path.join(SRC_PATH, 'myvariant_ids.bloom')
+ID_FILTER_FP_RATE = 0.01    # false positive rate, ~1.2 bytes per id at 0.01
 
 
 ###############################
@@ -35,5 +46,19 @@ HG19_DATAFILE = '/path/to/hg19_bit_p13.pyobj'
 ###############################
 FIELD_NOTES_PATH = os.path.join(SRC_PATH, 'www/context/myvariant_field_table_notes.json')
 JSONLD_CONTEXT_PATH = os.path.join(SRC_PATH, 'www/context/context.json')
+ES_ASYNC_WORKERS = 100    # max number of in-flight ES requests per process
+# in-process cache for /variant GET lookups
+VARIANT_CACHE_SIZE = 10000    # max number of cached variant docs
+VARIANT_CACHE_TTL = 3600      # in seconds
+BUILD_VERSION_CHECK_INTERVAL = 60    # how often (seconds) to check index _meta for a new build
+NDJSON_BATCH_SIZE = 100    # ids per concurrent sub-batch for out_format=ndjson POST requests
+FETCH_ALL_PAGE_SIZE = 1000    # hits per page (per slice) of fetch_all queries
+HEALTH_CHECK_INTERVAL = 10    # how often (seconds) to ping ES for /status
+HEALTH_CHECK_TIMEOUT = 2      # in seconds
+STATUS_CHECK_ID = 'chr1:g.218631822G>A'    # variant fetched by /status?deep=1
 GA_ACCOUNT = ''
+GA_QUEUE_SIZE = 10000    # GA hits queued at most, new hits are dropped when full
+GA_BATCH_SIZE = 500      # GA hits sent per flush
+GA_FLUSH_INTERVAL = 5    # in seconds
+#GA_ENDPOINT = 'http://localhost:8001/__utm.gif'    # to send hits to tests/ga_collector.py
 RUN_IN_PROD = False    # set to True in prod server
@@ -2,7 +2,7 @@ from __future__ import print_function
 from time import sleep, time
 import config
 from elasticsearch.helpers import bulk
-from utils.es import ESIndexer, get_es
+from utils.es import ESIndexer, get_es, get_routing, add_hg38_id
 from utils.mongo import get_src_db
 from utils.diff import apply_patch, diff_collections, get_backend
 from utils.common import loadobj, get_random_string, timesofar
@@ -19,6 +19,14 @@ class ESSyncer():
         self._src = get_src_db()
         self.step = step
 
+    def _routed(self, es_info):
+        '''set the routing of a bulk action, so that it goes to the same
+           shard as ESIndexer would use (see utils.es.get_routing).'''
+        routing = get_routing(es_info['_id'])
+        if routing:
+            es_info['_routing'] = routing
+        return es_info
+
     def add(self, collection, ids):
         # compare id_list with current index, get list of ids with true/false indicator
         id_list = []
@@ -42,7 +50,7 @@ class ESSyncer():
                     '_index': self._index,
                     '_type': self._doc_type,
                     "_id": _id,
-                    'doc': self._src[collection].find_one({'_id': _id})
+                    'doc': add_hg38_id(self._src[collection].find_one({'_id': _id}))
                 }
                 cnt_update += 1
             # case two: this id not exists in current index, then create a new one
@@ -52,10 +60,10 @@ class ESSyncer():
                     '_index': self._index,
                     '_type': self._doc_type,
                     "_id": _id,
-                    '_source': self._src[collection].find_one({'_id': _id})
+                    '_source': add_hg38_id(self._src[collection].find_one({'_id': _id}))
                 }
                 cnt_create += 1
-            yield es_info
+            yield self._routed(es_info)
         print('items updated: ', cnt_update)
         print('items newly created: ', cnt_create)
 
@@ -87,7 +95,7 @@ class ESSyncer():
                         "script": 'ctx._source.remove("{}")'.format(field)
                     }
                     cnt_update += 1
-                yield es_info
+                yield self._routed(es_info)
             else:
                 print('id not exists: ', _id)
         print('items updated: ', cnt_update)
@@ -95,7 +103,7 @@ class ESSyncer():
 
     def _update_one(self, _id, _patch):
         doc = self._esi.get_variant(_id)['_source']
-        doc = apply_patch(doc, _patch)
+        doc = add_hg38_id(apply_patch(doc, _patch), _id)
         es_info = {
             '_op_type': 'index',
             '_index': self._index,
@@ -103,7 +111,7 @@ class ESSyncer():
             "_id": _id,
             '_source': doc
         }
-        return es_info
+        return self._routed(es_info)
 
     def update(self, id_patchs):
         for _id_patch in id_patchs:
@@ -135,6 +143,14 @@ class ESSyncer():
         delete_list = self.delete(collection, diff['delete'])
         update_list = self.update(diff['update'])
         t00 = time()
+        if getattr(config, 'ID_FILTER_PATH', None):
+            # the web nodes would answer the new ids as not found from the
+            # current id filter, make them drop it before adding any doc.
+            self._esi.mark_updated()
+            wait_meta = getattr(config, 'BUILD_VERSION_CHECK_INTERVAL', 60)
+            print('Waiting {}s for the web nodes to drop the id filter...'.format(wait_meta), end="")
+            sleep(wait_meta)
+            print("Done.")
         print('Adding new {} docs...'.format(len(diff['add'])))
         t0 = time()
         bulk(self._es, add_list)
@@ -147,6 +163,11 @@ class ESSyncer():
         t0 = time()
         bulk(self._es, update_list)
         print("Done. [{}]".format(timesofar(t0)))
+        if getattr(config, 'ID_FILTER_PATH', None):
+            print('Rebuilding id filter...')
+            t0 = time()
+            self._esi.build_id_filter()
+            print("Done. [{}]".format(timesofar(t0)))
         print("="*20)
         print("Finished! [{}]".format(timesofar(t00)))
         if validate:
@@ -1,5 +1,6 @@
 #ES mapping
 import importlib
+import config
 
 
 def get_mapping(sources=None):
@@ -31,9 +32,111 @@ def get_mapping(sources=None):
     for extra_mapping in extra_mapping_li:
         m['variant']['properties'].update(extra_mapping)
 
+    add_position_mapping(m['variant']['properties'])
+    add_hg38_id_mapping(m['variant'])
     return m
 
 
+# Genomic position fields of each source, the defaults of the HG19_FIELDS,
+# HG38_FIELDS and CHROM_FIELDS settings in config (also used by the API to
+# query indices built without the canonical position fields below).
+HG38_FIELDS = ['clinvar.hg38', 'dbnsfp.hg38', 'evs.hg38']
+HG19_FIELDS = ['clinvar.hg19', 'cosmic.hg19', 'dbnsfp.hg19', 'dbsnp.hg19', 'docm.hg19', 'evs.hg19', 'grasp.hg19'] #, 'mutdb.hg19', 'wellderly.hg19']
+CHROM_FIELDS = ['cadd.chrom', 'clinvar.chrom', 'cosmic.chrom', 'dbnsfp.chrom', 'dbsnp.chrom', 'docm.chrom',
+                'evs.chrom', 'exac.chrom']#, 'mutdb.chrom', 'wellderly.chrom']
+
+
+# Canonical genomic position fields of a merged doc: "chrom", "hg19.start",
+# "hg19.end", "hg38.start" and "hg38.end". They are filled at index time, via
+# copy_to, from the source fields in the settings above, so an interval
+# query only needs to hit these fields (see ESQueryBuilder.build_interval_query).
+# They are not part of _source, so the returned docs are unchanged.
+#
+# Each canonical field holds the values of all the sources of a doc, so an
+# interval query on them matches a doc when the span of its source positions
+# (lowest start to highest end) overlaps the interval, where a query on the
+# source fields matches when one source position overlaps it. Both are the
+# same unless the sources of a variant disagree on its position.
+INTERNAL_FIELDS = ['chrom', 'hg19', 'hg38']
+
+
+def get_position_sources():
+    '''return the source fields each canonical position field is filled
+       from, as {"chrom": [...], "hg19": [...], "hg38": [...]} of source
+       names (e.g. "clinvar"), from the settings in config.'''
+    return {
+        'chrom': [f.rsplit('.', 1)[0] for f in getattr(config, 'CHROM_FIELDS', CHROM_FIELDS)],
+        'hg19': [f.rsplit('.', 1)[0] for f in getattr(config, 'HG19_FIELDS', HG19_FIELDS)],
+        'hg38': [f.rsplit('.', 1)[0] for f in getattr(config, 'HG38_FIELDS', HG38_FIELDS)]
+    }
+
+position_mapping = {
+    "chrom": {
+        "type": "string",
+        "analyzer": "string_lowercase"
+    },
+    "hg19": {
+        "properties": {
+            "start": {
+                "type": "long"
+            },
+            "end": {
+                "type": "long"
+            }
+        }
+    },
+    "hg38": {
+        "properties": {
+            "start": {
+                "type": "long"
+            },
+            "end": {
+                "type": "long"
+            }
+        }
+    }
+}
+
+
+def add_position_mapping(properties):
+    '''add the canonical position fields to the "properties" of a variant
+       mapping, and copy_to settings to the matching fields of each source.
+       Sources without such fields in their mapping are skipped.'''
+    for field, sources in get_position_sources().items():
+        for src in sources:
+            src_properties = properties
+            for key in src.split('.'):
+                src_properties = src_properties.get(key, {}).get('properties', {})
+            if field == 'chrom':
+                if 'chrom' in src_properties:
+                    src_properties['chrom']['copy_to'] = 'chrom'
+            else:
+                pos_properties = src_properties.get(field, {}).get('properties', {})
+                for key in ('start', 'end'):
+                    if key in pos_properties:
+                        pos_properties[key]['copy_to'] = field + '.' + key
+    properties.update(position_mapping)
+    return properties
+
+
+# hg38 HGVS id of a merged doc (the _id is on hg19), built at index time from
+# the hg38 start position of the sources below (see utils.es.add_hg38_id), so
+# a variant can be looked up by its hg38 id with one term query. It's kept
+# in the stored _source, so that partial updates (merged into _source) do not
+# drop it, and removed from the docs returned by the API.
+HG38_ID_FIELD = 'hg38_id'
+HG38_ID_SOURCES = get_position_sources()['hg38']
+
+
+def add_hg38_id_mapping(type_mapping):
+    '''add the hg38 id field to a variant type mapping.'''
+    type_mapping['properties'][HG38_ID_FIELD] = {
+        "type": "string",
+        "index": "not_analyzed"
+    }
+    return type_mapping
+
+
 '''
 mapping = {
     "mappings": {
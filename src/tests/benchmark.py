@@ -0,0 +1,231 @@
+'''
+Micro-benchmarks for the web node, run from the src folder as:
+
+    python tests/benchmark.py <benchmark_name> [-n <repeat>]
+
+Available benchmarks are listed with "python tests/benchmark.py -h".
+Merged variant documents are taken from docs/doc/variant_object.json.
+Benchmarks querying ES (e.g. interval) use the ES host in config.py.
+'''
+from __future__ import print_function
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+src_path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+VARIANT_OBJECT_PATH = os.path.join(src_path, '../docs/doc/variant_object.json')
+
+
+def load_variant_object():
+    '''return the example merged variant doc used in the docs.'''
+    with open(VARIANT_OBJECT_PATH) as in_f:
+        in_f.readline()    # skip the ".. code-block :: json" line
+        return json.load(in_f)
+
+
+def get_merged_docs(n=100):
+    '''return n copies of the example merged variant doc.'''
+    doc = load_variant_object()
+    return [copy.deepcopy(doc) for i in range(n)]
+
+
+def timeit(fn, docs, repeat=5):
+    '''return the best per-doc time (in microseconds) of applying fn to
+       fresh copies of docs.'''
+    best = None
+    for i in range(repeat):
+        _docs = copy.deepcopy(docs)
+        t0 = time.time()
+        for doc in _docs:
+            fn(doc)
+        t = (time.time() - t0) / len(_docs)
+        best = t if best is None else min(best, t)
+    return best * 1e6
+
+
+def report(name, results):
+    print(name)
+    base = results[0][1]
+    for label, t in results:
+        print('\t{:<30}{:>12.1f} us/doc  {:>6.2f}x'.format(label, t, base / t))
+
+
+def bench_jsonld(repeat):
+    '''per-doc cost of inserting jsonld context into large merged docs.'''
+    import config
+    from utils.common import find_doc
+    from www.api.es import compile_jsonld_context, apply_jsonld_context
+
+    with open(config.JSONLD_CONTEXT_PATH) as in_f:
+        context = json.load(in_f)
+    trie = compile_jsonld_context(context)
+
+    def insert_jsonld_by_path(k):
+        # the original implementation, walking each context path separately
+        k.update(context['root'])
+        for key in context:
+            if key != 'root':
+                keys = key.split('/')
+                try:
+                    doc = find_doc(k, keys)
+                    if type(doc) == list:
+                        for _d in doc:
+                            _d.update(context[key])
+                    elif type(doc) == dict:
+                        doc.update(context[key])
+                except:
+                    continue
+        return k
+
+    docs = get_merged_docs()
+    _docs = copy.deepcopy(docs)
+    for doc1, doc2 in zip(docs, _docs):
+        insert_jsonld_by_path(doc1)
+        apply_jsonld_context(doc2, trie)
+    assert docs == _docs, "jsonld output does not match."
+    report('jsonld=true on merged docs', [
+        ('per-path lookup', timeit(insert_jsonld_by_path, docs, repeat)),
+        ('compiled trie', timeit(lambda doc: apply_jsonld_context(doc, trie), docs, repeat)),
+    ])
+
+
+def bench_startup(repeat):
+    '''time to import the web node and build its tornado Application,
+       measured in a fresh process each time. No ES request is needed.'''
+    import subprocess
+    code = ('import time; t0 = time.time(); '
+            'import tornado.web, www.index; tornado.web.Application(www.index.APP_LIST); '
+            'print(time.time() - t0)')
+    times = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=src_path)
+        times.append(float(out.decode('utf-8').strip().splitlines()[-1]) * 1000)
+    print('startup (import www.index and build Application)')
+    print('\tbest {:.1f} ms, mean {:.1f} ms'.format(min(times), sum(times) / len(times)))
+
+
+def bench_serialize(repeat):
+    '''per-doc cost of encoding merged docs as a response body.'''
+    from collections import OrderedDict
+    from utils.serializer import DateTimeJSONEncoder, to_json, to_msgpack
+
+    def sort_response_object(d, depth=0):
+        # the original BaseHandler._sort_response_object
+        depth += 1
+        if depth <= 6 and isinstance(d, list):
+            return [sort_response_object(ds, depth) for ds in d]
+        elif depth <= 6 and isinstance(d, dict):
+            return OrderedDict([(k, sort_response_object(d[k], depth)) for k in sorted(d)])
+        else:
+            return d
+
+    def legacy_json(doc):
+        return json.dumps(sort_response_object(doc), cls=DateTimeJSONEncoder, indent=2)
+
+    def legacy_msgpack(doc):
+        return to_msgpack(sort_response_object(doc))
+
+    docs = get_merged_docs()
+    assert json.loads(legacy_json(docs[0])) == json.loads(to_json(docs[0])), "JSON output does not match."
+    report('JSON encoding of merged docs', [
+        ('sorted copy + indent=2', timeit(legacy_json, docs, repeat)),
+        ('sort_keys, pretty=1', timeit(lambda doc: to_json(doc, indent=2), docs, repeat)),
+        ('sort_keys, compact', timeit(to_json, docs, repeat)),
+    ])
+    report('msgpack encoding of merged docs', [
+        ('sorted copy', timeit(legacy_msgpack, docs, repeat)),
+        ('as is', timeit(to_msgpack, docs, repeat)),
+    ])
+
+
+def bench_passthrough(repeat):
+    '''per-doc cost of turning an ES get response into a /variant response.'''
+    from utils.serializer import to_json
+    from www.api.es import splice_variantdoc
+
+    doc = load_variant_object()
+    # docs with "cadd" are post-processed (CADD license), not passed through
+    doc.pop('cadd', None)
+    doc.get('dbnsfp', {}).pop('cadd', None)
+    _id = doc.pop('_id')
+    doc.pop('_version', None)
+    res = json.dumps({'_index': 'myvariant_current', '_type': 'variant', '_id': _id,
+                      '_version': 1, 'found': True, '_source': doc}, separators=(',', ':'))
+    responses = [res] * 100
+
+    def decode_encode(res):
+        hit = json.loads(res)
+        doc = hit['_source']
+        doc['_id'], doc['_version'] = hit['_id'], hit['_version']
+        return to_json(doc)
+
+    assert json.loads(decode_encode(res)) == json.loads(splice_variantdoc(res)), "output does not match."
+    report('ES get response to /variant response', [
+        ('decode + encode', timeit(decode_encode, responses, repeat)),
+        ('splice _source', timeit(splice_variantdoc, responses, repeat)),
+    ])
+
+
+def bench_interval(repeat):
+    '''latency of interval queries over the position fields of every source,
+       vs. over the canonical position fields. Needs the ES host in config.py,
+       with an index built with the canonical fields (see dataindex/mapping.py).'''
+    from www.api.es import ESQuery, ESQueryBuilder
+    esq = ESQuery()
+    qbdr = ESQueryBuilder()
+    intervals = [('1', 10000, 100000), ('2', 1000000, 1100000),
+                 ('7', 117120017, 117308718), ('17', 41196312, 41277500), ('X', 30000000, 30500000)]
+
+    def run(position_fields):
+        best_took, best_wall, totals = None, None, []
+        for i in range(repeat):
+            took = wall = 0
+            totals = []
+            for chrom, start, end in intervals:
+                _q = qbdr.build_interval_query(chrom, start, end, None, hg38=False, position_fields=position_fields)
+                t0 = time.time()
+                res = esq._es.search(index=esq._index, doc_type=esq._doc_type, body=_q, size=10)
+                wall += time.time() - t0
+                took += res['took']
+                totals.append(res['hits']['total'])
+            best_took = took if best_took is None else min(best_took, took)
+            best_wall = wall if best_wall is None else min(best_wall, wall)
+        n = len(intervals)
+        return float(best_took) / n, best_wall * 1000 / n, totals
+
+    print('interval queries ({} intervals, hg19)'.format(len(intervals)))
+    for label, position_fields in [('all source fields', False), ('canonical fields', True)]:
+        took, wall, totals = run(position_fields)
+        print('\t{:<30}{:>8.1f} ms took {:>8.1f} ms wall   hits: {}'.format(label, took, wall, totals))
+
+
+BENCHMARKS = {
+    'interval': bench_interval,
+    'jsonld': bench_jsonld,
+    'passthrough': bench_passthrough,
+    'serialize': bench_serialize,
+    'startup': bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MyVariant.info web node micro-benchmarks.')
+    parser.add_argument('benchmark', nargs='*',
+                        help='benchmarks to run ({}), all if not specified.'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='number of repeats, best one is reported.')
+    args = parser.parse_args()
+    unknown = set(args.benchmark) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: {}'.format(', '.join(sorted(unknown))))
+    for name in args.benchmark or sorted(BENCHMARKS):
+        BENCHMARKS[name](args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+A local stand-in for the Google Analytics collector, to test GA tracking
+without sending hits to GA. Run it from the src folder as:
+
+    python tests/ga_collector.py [--port=8001]
+
+and set in config.py:
+
+    RUN_IN_PROD = True
+    GA_ACCOUNT = 'UA-00000000-0'
+    GA_ENDPOINT = 'http://localhost:8001/__utm.gif'
+
+Each received hit is logged, and the counts of hits received so far are
+returned by GET /stats.
+'''
+import json
+import logging
+
+import tornado.escape
+import tornado.ioloop
+import tornado.options
+import tornado.web
+from tornado.options import define, options
+
+define("port", default=8001, help="run on the given port", type=int)
+
+hit_counts = {}    # hit type (page or event) --> count
+
+
+class CollectorHandler(tornado.web.RequestHandler):
+    def _collect(self, args):
+        hit_type = args.get('utmt', 'page')
+        hit_counts[hit_type] = hit_counts.get(hit_type, 0) + 1
+        logging.info('%s %s %s', hit_type, args.get('utmp', ''), args.get('utme', ''))
+        self.set_header('Content-Type', 'image/gif')
+
+    def get(self):
+        self._collect(dict((k, self.get_argument(k)) for k in self.request.arguments))
+
+    def post(self):
+        # long hits are sent as a text/plain POST body
+        args = tornado.escape.parse_qs_bytes(self.request.body)
+        self._collect(dict((k, v[0].decode('utf-8')) for k, v in args.items()))
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(json.dumps(hit_counts))
+
+
+def main():
+    tornado.options.parse_command_line()
+    application = tornado.web.Application([
+        (r"/__utm.gif", CollectorHandler),
+        (r"/stats", StatsHandler),
+    ])
+    application.listen(options.port)
+    logging.info('GA collector is running on port %s...', options.port)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+if __name__ == "__main__":
+    main()
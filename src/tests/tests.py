@@ -12,9 +12,16 @@ except ImportError:
 import json
 import sys
 import os
+import base64
+import tempfile
 from nose.tools import ok_, eq_
 import variant_list
 
+src_path = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
+if src_path not in sys.path:
+    sys.path.append(src_path)
+from utils.bloom import BloomFilter
+
 try:
     import msgpack
 except ImportError:
@@ -190,11 +197,56 @@ def test_query_interval():
     ok_('_id' in res['hits'][0])
 
 
+def test_query_interval_span():
+    # a hit matches when the span of the positions of its sources (lowest
+    # start to highest end) overlaps the interval
+    gstart, gend = 10000, 100000
+    res = json_ok(get_ok(api + '/query?q=chr1:{}-{}&size=100'.format(gstart, gend)))
+    ok_(len(res['hits']) > 1)
+    for hit in res['hits']:
+        starts, ends = [], []
+        for src in ['clinvar', 'cosmic', 'dbnsfp', 'dbsnp', 'docm', 'evs', 'grasp']:
+            values = hit.get(src, [])
+            for value in values if isinstance(values, list) else [values]:
+                if 'hg19' in value:
+                    starts.append(value['hg19']['start'])
+                    ends.append(value['hg19']['end'])
+        ok_(starts and min(starts) <= gend and max(ends) >= gstart)
+
+
 def test_query_size():
     # TODO
     pass
 
 
+def test_query_after():
+    q = api + '/query?q=dbnsfp.genename:BTK&fields=dbnsfp.genename&sort=dbnsfp.aa.pos&size='
+    res = json_ok(get_ok(q + '20'))
+    page1 = json_ok(get_ok(q + '10&after=start'))
+    page2 = json_ok(get_ok(q + '10&after=' + page1['next']))
+    eq_([hit['_id'] for hit in page1['hits'] + page2['hits']], [hit['_id'] for hit in res['hits']])
+    # no cursor unless requested
+    ok_('next' not in res)
+
+
+def test_query_after_rawquery():
+    # a hit sorted by dbnsfp.aa.pos (multi-valued) of 10, then by _uid
+    after = base64.urlsafe_b64encode(_e(['dbnsfp.aa.pos:desc,_uid:asc', [10, 'variant#chr1:g.1A>C']]).encode('utf-8'))
+    q = api + '/query?q=dbnsfp.genename:BTK&sort=-dbnsfp.aa.pos&rawquery=1&after=' + after.decode('ascii')
+    res = json_ok(get_ok(q))
+    after_filter = res['query']['bool']['filter']['bool']['should']
+    eq_(len(after_filter), 2)
+    # sorted after the hit: a lower max value, or missing
+    gt = after_filter[0]['bool']['must'][0]['bool']['should']
+    eq_(gt[0]['bool']['must'][1]['script']['script']['inline'], "doc['dbnsfp.aa.pos'].max() < value")
+    eq_(gt[0]['bool']['must'][1]['script']['script']['params'], {'value': 10})
+    eq_(gt[1], {'bool': {'must_not': {'exists': {'field': 'dbnsfp.aa.pos'}}}})
+    # or the same max value and a greater _uid
+    same, gt = after_filter[1]['bool']['must']
+    eq_(same['bool']['must'][1]['script']['script']['inline'], "doc['dbnsfp.aa.pos'].max() == value")
+    eq_(gt, {'range': {'_uid': {'gt': 'variant#chr1:g.1A>C'}}})
+
+
 def test_variant():
     # TODO
     res = json_ok(get_ok(api + '/variant/chr16:g.28883241A>G'))
@@ -223,6 +275,25 @@ def test_variant():
     get_404(api + '/variant/')
 
 
+def test_variant_passthrough():
+    from collections import OrderedDict
+
+    def _sorted_keys(d):
+        if isinstance(d, dict):
+            return list(d) == sorted(d) and all(_sorted_keys(v) for v in d.values())
+        if isinstance(d, list):
+            return all(_sorted_keys(v) for v in d)
+        return True
+
+    url = api + '/variant/chr16:g.28883241A>G'
+    con = get_ok(url)
+    res = json.loads(con.decode('utf-8'), object_pairs_hook=OrderedDict)
+    ok_(_sorted_keys(res))
+    # only passed through as stored, with keys in any order, when asked for
+    res2 = json_ok(get_ok(url + '?passthrough=1'))
+    eq_(res2, json.loads(con.decode('utf-8')))
+
+
 def test_variant_post():
     res = json_ok(post_ok(api + '/variant', {'ids': 'chr16:g.28883241A>G'}))
     eq_(len(res), 1)
@@ -249,11 +320,75 @@ def test_variant_post():
     eq_(len(res), 999)
 
 
+def test_variant_post_exists():
+    res = json_ok(post_ok(api + '/variant', {'ids': 'chr16:g.28883241A>G, chr1:g.1A>C', 'exists': 'true'}))
+    eq_(res, [True, False])
+    res = json_ok(post_ok(api + '/query', {'q': 'rs58991260, rs0', 'scopes': 'dbsnp.rsid', 'exists': 'true'}))
+    eq_(res, [True, False])
+    # hg38 ids
+    res = json_ok(post_ok(api + '/variant', {'ids': 'chr11:g.56086482C>A, chr1:g.1A>C', 'exists': 'true',
+                                             'assembly': 'hg38'}))
+    eq_(res, [True, False])
+
+    res = json_ok(get_ok(api + '/query?q=dbnsfp.genename:BTK&size=0'))
+    assert res['total'] > 0
+    assert 'hits' not in res
+
+
+def test_variant_post_ndjson():
+    con = post_ok(api + '/variant', {'ids': 'chr16:g.28883241A>G, chr11:g.66397320A>G, chr1:g.1A>C',
+                                     'out_format': 'ndjson'})
+    res = [_d(line) for line in con.decode('utf-8').splitlines()]
+    eq_([r['query'] for r in res], ['chr16:g.28883241A>G', 'chr11:g.66397320A>G', 'chr1:g.1A>C'])
+    eq_(res[2]['notfound'], True)
+
+    con = post_ok(api + '/query', {'q': variant_list.VARIANT_POST_LIST, 'out_format': 'ndjson',
+                                   'ordered': 'false', 'fields': '_id'})
+    eq_(len(con.decode('utf-8').splitlines()), 999)
+
+
+def test_status():
+    eq_(get_ok(host + '/status'), b'OK')
+    head_ok(host + '/status')
+    get_ok(host + '/status/live')
+    res = json_ok(get_ok(host + '/status/ready?deep=1'))
+    ok_(res['ok'] and res['deep'])
+
+
+def test_status_worker():
+    res = json_ok(get_ok(host + '/status/worker'))
+    ok_('pid' in res and 'uptime' in res and 'requests' in res)
+
+
+def test_metrics():
+    get_ok(api + '/variant/chr11:g.66397320A>G')
+    con = get_ok(host + '/metrics').decode('utf-8')
+    ok_('myvariant_request_duration_seconds_count{endpoint="variant_get"}' in con)
+    ok_('myvariant_request_stage_duration_seconds_count{endpoint="variant_get",stage="es_request"}' in con)
+    # hg38 ids are looked up with a search, which reports its took time
+    get_ok(api + '/variant/chr11:g.56319006C>A?assembly=hg38')
+    con = get_ok(host + '/metrics').decode('utf-8')
+    ok_('myvariant_request_stage_duration_seconds_count{endpoint="variant_get",stage="es_took"}' in con)
+
+
 def test_metadata():
     #get_ok(host + '/metadata')
     get_ok(api + '/metadata')
 
 
+def test_conditional_get():
+    url = api + '/variant/chr11:g.66397320A>G'
+    res, con = h.request(url)
+    eq_(res.status, 200)
+    ok_('etag' in res and 'last-modified' in res)
+    res, con = h.request(url, headers={'If-None-Match': res['etag']})
+    eq_(res.status, 304)
+    eq_(con, b'')
+    # different parameters should not match
+    res2, con = h.request(url + '?fields=dbsnp', headers={'If-None-Match': res['etag']})
+    eq_(res2.status, 200)
+
+
 def test_query_facets():
     pass
 
@@ -293,17 +428,50 @@ def test_get_fields():
     assert 'dbsnp' in res
     assert 'wellderly' in res
     assert 'clinvar' in res
+    # internal fields
+    assert 'chrom' not in res
+    assert 'hg19.start' not in res
+    assert 'hg38.end' not in res
+    assert 'hg38_id' not in res
+    assert 'clinvar.hg19.start' in res
 
 
 def test_fetch_all():
     res = json_ok(get_ok(api + '/query?q=_exists_:wellderly%20AND%20cadd.polyphen.cat:possibly_damaging&fields=wellderly,cadd.polyphen&fetch_all=TRUE'))
     assert '_scroll_id' in res
+    eq_(res['hits'], [])
 
     # get one set of results
     res2 = json_ok(get_ok(api + '/query?scroll_id=' + res['_scroll_id']))
     assert 'hits' in res2
     ok_(len(res2['hits']) == 1000)
 
+    # raw scroll results are the ES response, not streamed
+    res3 = json_ok(get_ok(api + '/query?raw=1&scroll_id=' + res2['_scroll_id']))
+    ok_(isinstance(res3['hits'], dict))
+    ok_(len(res3['hits']['hits']) == 1000)
+
+    # the same results, split into two slices
+    q = api + '/query?q=_exists_:wellderly%20AND%20cadd.polyphen.cat:possibly_damaging&fields=wellderly&fetch_all=true&slices=2&slice='
+    slices = [json_ok(get_ok(q + str(i))) for i in range(2)]
+    eq_(sum(_res['total'] for _res in slices), res['total'])
+    ok_(all('_scroll_id' in _res for _res in slices))
+
+    # the first page of hits in the first response
+    res4 = json_ok(get_ok(api + '/query?q=_exists_:wellderly%20AND%20cadd.polyphen.cat:possibly_damaging&fields=wellderly&fetch_all=true&first_page=true'))
+    ok_(len(res4['hits']) == 1000)
+    eq_(res4['total'], res['total'])
+
+    # an interval query is in one shard if the index is routed by chromosome,
+    # the slices still split its results, with no hits in the other slices then
+    q = api + '/query?q=chr1:10000-1000000&fetch_all=true'
+    res5 = json_ok(get_ok(q))
+    slices = [json_ok(get_ok(q + '&slices=2&slice=' + str(i))) for i in range(2)]
+    eq_(sum(_res['total'] for _res in slices), res5['total'])
+    for _res in slices:
+        eq_(_res['hits'], [])
+        ok_(_res['total'] == 0 or '_scroll_id' in _res)
+
 
 def test_msgpack():
     res = json_ok(get_ok(api + '/variant/chr11:g.66397320A>G'))
@@ -319,6 +487,14 @@ def test_msgpack():
     ok_(res, res2)
 
 
+def test_pretty():
+    con = get_ok(api + '/variant/chr11:g.66397320A>G').decode('utf-8')
+    ok_('\n' not in con)
+    con2 = get_ok(api + '/variant/chr11:g.66397320A>G?pretty=1').decode('utf-8')
+    ok_(con2.startswith('{\n  "'))
+    eq_(_d(con), _d(con2))
+
+
 def test_licenses():
     # cadd license
     res = json_ok(get_ok(api + '/query?q=_exists_:cadd&size=1&fields=cadd'))
@@ -363,6 +539,32 @@ def test_jsonld():
 def test_genome_assembly():
     res = json_ok(get_ok(api + '/query?q=clinvar.ref:C%20AND%20chr11:56319006%20AND%20clinvar.alt:A&assembly=hg38'))
     eq_(res["hits"][0]["_id"], "chr11:g.56086482C>A")
+    res = json_ok(get_ok(api + '/variant/chr11:g.56319006C>A?assembly=hg38'))
+    eq_(res["_id"], "chr11:g.56086482C>A")
+
+
+def test_concurrent_requests():
+    # requests with different jsonld/assembly settings served at the same time
+    # should not affect each other.
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _get(i):
+        jsonld = i % 2 == 0
+        _h = httplib2.Http()
+        res, con = _h.request(api + '/variant/chr11:g.66397320A>G?jsonld={}'.format(jsonld))
+        eq_(res.status, 200)
+        eq_('@context' in _d(con.decode('utf-8')), jsonld)
+        assembly = 'hg38' if jsonld else 'hg19'
+        res, con = _h.request(api + '/query?q=clinvar.ref:C%20AND%20chr11:56319006%20AND%20clinvar.alt:A&assembly=' + assembly)
+        eq_(res.status, 200)
+        hit_ids = [hit['_id'] for hit in _d(con.decode('utf-8'))['hits']]
+        # chr11:56319006 is the hg38 position of this variant
+        eq_('chr11:g.56086482C>A' in hit_ids, assembly == 'hg38')
+        return True
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        ok_(all(executor.map(_get, range(50))))
+
 
 def test_HGVS_redirect():
     res = json_ok(get_ok(api + '/variant/chr11:66397320A>G'))
@@ -375,6 +577,11 @@ def test_HGVS_redirect():
     eq_(res3, res4)
     eq_(res["_id"], 'chr11:g.66397320A>G')
 
+    res = json_ok(post_ok(api + '/variant', {'ids': 'chr11:66397320a>g, 11:g.66397320A>G'}))
+    eq_([hit['_id'] for hit in res], ['chr11:g.66397320A>G'] * 2)
+    eq_([hit['query'] for hit in res], ['chr11:66397320a>g', '11:g.66397320A>G'])
+
+
 def test_beacon_get():
     res = json_ok(get_ok(host + '/beacon/wellderly?chrom=12&pos=328665&allele=G'))
     res2 = json_ok(get_ok(host + '/beacon/dbsnp?chrom=12&pos=328665&allele=G'))
@@ -401,4 +608,53 @@ def test_beacon_post():
     ok_(res['exists'])
     ok_(res2['exists'])
     ok_(res3['exists'])    
-    ok_(not res4['exists'])    
\ No newline at end of file
+    ok_(not res4['exists'])    
+
+
+#############################################################
+# Unit tests, no server needed                              #
+#############################################################
+def test_bloom_filter():
+    ids = ['chr1:g.{}G>A'.format(i) for i in range(10000)]
+    bf = BloomFilter(capacity=len(ids), fp_rate=0.01)
+    for _id in ids:
+        bf.add(_id)
+    eq_(len(bf), len(ids))
+    # no false negatives
+    ok_(all(_id in bf for _id in ids))
+    # false positive rate at capacity
+    others = ['chr2:g.{}C>T'.format(i) for i in range(10000)]
+    fp_rate = sum(_id in bf for _id in others) / float(len(others))
+    ok_(fp_rate < 0.02, fp_rate)
+
+
+def test_bloom_filter_save_load():
+    ids = ['chr1:g.{}G>A'.format(i) for i in range(1000)]
+    bf = BloomFilter(capacity=len(ids))
+    for _id in ids:
+        bf.add(_id)
+    meta = {'build_version': '20161018', 'updated': '2016-10-19T10:00:00'}
+    path = os.path.join(tempfile.mkdtemp(), 'ids.bloom')
+    bf.save(path, meta=meta)
+    bf2 = BloomFilter.load(path)
+    eq_(len(bf2), len(ids))
+    eq_(bf2.meta, meta)
+    ok_(all(_id in bf2 for _id in ids))
+    eq_([_id in bf2 for _id in ['chr2:g.1C>T', 'chr2:g.2C>T']], [_id in bf for _id in ['chr2:g.1C>T', 'chr2:g.2C>T']])
+    bf2.close()
+
+    # a new _meta: the filter is saved again with it, only if it was built
+    # from the previous one (see ESIndexer.update_mapping_meta)
+    from utils.es import ESIndexer
+    esi = ESIndexer()
+    new_meta = dict(meta, build_version='20161020')
+    esi._update_id_filter_meta(dict(meta, updated='2016-10-20T10:00:00'), new_meta, path=path)
+    bf3 = BloomFilter.load(path)
+    eq_(bf3.meta, meta)
+    bf3.close()
+    esi._update_id_filter_meta(meta, new_meta, path=path)
+    bf3 = BloomFilter.load(path)
+    eq_(bf3.meta, new_meta)
+    eq_(len(bf3), len(ids))
+    ok_(all(_id in bf3 for _id in ids))
+    bf3.close()
@@ -0,0 +1,112 @@
+'''
+A Bloom filter of the variant ids in the index, used by the web nodes as a
+negative cache: an id not in the filter is definitely not in the index, so
+it can be answered as not found without an ES request. An id in the filter
+is in the index, or (at the configured false positive rate) a miss that
+costs the usual ES request.
+
+The filter is built by ESIndexer.build_id_filter after an index build and
+saved to a file, which the web nodes memory-map, so that all the worker
+processes of a node share one copy in the OS page cache:
+
+    bf = BloomFilter(capacity=n, fp_rate=0.01)
+    for _id in ids:
+        bf.add(_id)
+    bf.save(path, meta=index_meta)
+
+    bf = BloomFilter.load(path)
+    'chr1:g.35367G>A' in bf
+
+The file stores the index _meta it was built from, see BloomFilter.meta.
+The web nodes only use a filter whose meta is the current index _meta:
+ESIndexer.mark_updated changes the _meta before docs are added, and
+ESIndexer.update_mapping_meta saves the filter again with the new _meta
+when it was built from the old one.
+'''
+import os
+import math
+import mmap
+import json
+import struct
+import hashlib
+
+MAGIC = b'MVBLOOM1'
+# num_bits, num_hashes, count, length of the json-encoded meta
+HEADER = struct.Struct('<QQQQ')
+
+
+class BloomFilter():
+    def __init__(self, capacity=None, fp_rate=0.01, num_bits=None, num_hashes=None):
+        '''size the filter for capacity ids at fp_rate false positives,
+           or pass num_bits and num_hashes explicitly.'''
+        if num_bits is None:
+            capacity = max(capacity or 0, 1)
+            num_bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+            num_hashes = max(int(round(num_bits / capacity * math.log(2))), 1)
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = 0        # number of ids added
+        self.meta = {}        # the index _meta the filter was built from
+        self._bits = bytearray((num_bits + 7) // 8)
+        self._offset = 0      # start of the bit array in self._bits
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        # double hashing (Kirsch & Mitzenmacher): the k positions are
+        # derived from the two halves of one md5 digest.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits, offset = self._bits, self._offset
+        for pos in self._positions(key):
+            if not bits[offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def save(self, path, meta=None):
+        '''write the filter to path, along with the index _meta (a dict).
+           It's written to a temp file first and then renamed, so the web
+           nodes never load a partial file.'''
+        meta = json.dumps(meta if meta is not None else self.meta, sort_keys=True).encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as out_f:
+            out_f.write(MAGIC)
+            out_f.write(HEADER.pack(self.num_bits, self.num_hashes, self.count, len(meta)))
+            out_f.write(meta)
+            out_f.write(self._bits[self._offset:] if self._offset else self._bits)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''return the filter saved in path, memory-mapped read-only.'''
+        with open(path, 'rb') as in_f:
+            mm = mmap.mmap(in_f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            raise ValueError('"{}" is not a Bloom filter file.'.format(path))
+        start = len(MAGIC) + HEADER.size
+        num_bits, num_hashes, count, meta_len = HEADER.unpack(mm[len(MAGIC):start])
+        bf = cls.__new__(cls)    # skip allocating the bit array
+        bf.num_bits = num_bits
+        bf.num_hashes = num_hashes
+        bf.count = count
+        bf.meta = json.loads(mm[start:start + meta_len].decode('utf-8'))
+        bf._bits = mm
+        bf._offset = start + meta_len
+        return bf
+
+    def close(self):
+        if isinstance(self._bits, mmap.mmap):
+            self._bits.close()
@@ -0,0 +1,69 @@
+'''
+Simple in-process caches used by the web nodes.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    '''A thread-safe, size-bounded LRU cache with an optional TTL.
+
+       cache = LRUCache(maxsize=1000, ttl=3600)
+       cache.set(key, value)
+       cache.get(key)      # --> value, or None if missing/expired
+
+       hit/miss counters are kept and returned by self.stats().
+    '''
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl      # in seconds, None means never expire
+        self._data = OrderedDict()    # key --> (expire_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                expire_at, value = item
+                if expire_at is None or expire_at > time.time():
+                    # re-insert to mark as the most recently used
+                    self._data[key] = item
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expire_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expire_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        '''return a dictionary of the cache usage counters.'''
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / total if total else 0.0
+        }
@@ -404,7 +404,8 @@ def safewfile(filename, prompt=True, default='C', mode='w'):
 
 
 def find_doc(k,keys):
-    ''' Used by jsonld insertion in www.api.es._insert_jsonld '''
+    ''' Walk doc k along the path of keys, used by the original jsonld insertion
+        (now replaced by www.api.es.apply_jsonld_context, see tests/benchmark.py). '''
     n = len(keys)
     for i in range(n):
         # if k is a dictionary, then directly get its value
@@ -1,12 +1,16 @@
 from __future__ import print_function
+import os
 import time
 import json
 from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch import helpers
+from elasticsearch.serializer import JSONSerializer
 
 import config
 from utils.common import iter_n, timesofar, ask
-from dataindex.mapping import get_mapping
+from utils.hgvs import get_hgvs_chrom, normalize_chrom, shift_hgvs
+from utils.bloom import BloomFilter
+from dataindex.mapping import get_mapping, HG38_ID_FIELD, HG38_ID_SOURCES
 
 # setup ES logging
 import logging
@@ -46,12 +50,76 @@ def verify_ids(doc_iter, step=100000, index=None, doc_type=None):
     return out
 
 
-def get_es(es_host=None):
+def get_es(es_host=None, **kwargs):
+    '''return an Elasticsearch client, extra kwargs (e.g. maxsize for the
+       connection pool) are passed to the client.'''
     es_host = es_host or config.ES_HOST
-    es = Elasticsearch(es_host, timeout=120)
+    es = Elasticsearch(es_host, timeout=120, **kwargs)
     return es
 
 
+class RawJSONSerializer(JSONSerializer):
+    '''does not decode ES responses, they are returned as JSON strings.'''
+    def loads(self, s):
+        return s
+
+
+def get_raw_es(es_host=None, **kwargs):
+    '''return an Elasticsearch client returning the responses as undecoded
+       JSON strings, to pass them through to the client as they are.'''
+    return get_es(es_host, serializers={RawJSONSerializer.mimetype: RawJSONSerializer()}, **kwargs)
+
+
+def get_routing(vid):
+    '''return the routing key of a variant id if ES_ROUTING_BY_CHROM is set
+       in config: its chromosome (e.g. "1" or "X"), so that all variants of a
+       chromosome are stored in the same shard. Return None, i.e. routed by
+       _id (ES default), otherwise or if vid does not start with a chromosome.
+
+       The same setting must be used when the index is built and queried.
+    '''
+    if getattr(config, 'ES_ROUTING_BY_CHROM', False):
+        return get_hgvs_chrom(vid)
+
+
+def get_chrom_routing(chrom):
+    '''return the routing key of all variants of a chromosome, see get_routing.'''
+    if getattr(config, 'ES_ROUTING_BY_CHROM', False) and chrom:
+        return normalize_chrom(chrom)
+
+
+def routing_kwargs(vid):
+    '''return {"routing": <routing key>} for a variant id, or {} if routed by _id.'''
+    routing = get_routing(vid)
+    return {'routing': routing} if routing else {}
+
+
+def get_hg38_id(doc):
+    '''return the hg38 hgvs id of a variant doc, from its _id and the hg38
+       start position of the first source (in HG38_ID_SOURCES) having one,
+       or None.'''
+    vid = doc.get('_id')
+    if not vid:
+        return
+    for src in HG38_ID_SOURCES:
+        values = doc.get(src)
+        for value in values if isinstance(values, list) else [values]:
+            try:
+                start = int(value['hg38']['start'])
+            except (TypeError, KeyError, ValueError):
+                continue
+            return shift_hgvs(vid, start)
+
+
+def add_hg38_id(doc, vid=None):
+    '''set the hg38 id field of a doc to be indexed (see get_hg38_id),
+       vid is the doc _id if it's not in the doc itself.'''
+    hg38_id = get_hg38_id(dict(doc, _id=vid) if vid else doc)
+    if hg38_id:
+        doc[HG38_ID_FIELD] = hg38_id
+    return doc
+
+
 def wrapper(func):
     '''this wrapper allows passing index and doc_type from wrapped method.'''
     def outter_fn(*args, **kwargs):
@@ -83,6 +151,7 @@ class ESIndexer():
 
     @wrapper
     def get_variant(self, vid, **kwargs):
+        kwargs.update(routing_kwargs(vid))
         return self._es.get(index=self._index, id=vid, doc_type=self._doc_type, **kwargs)
 
     @wrapper
@@ -156,25 +225,32 @@ class ESIndexer():
         '''add a doc to the index. If id is not None, the existing doc will be
            updated.
         '''
-        return self._es.index(self._index, self._doc_type, doc, id=id)
+        self._mark_updated_before_write()
+        add_hg38_id(doc, id)
+        return self._es.index(self._index, self._doc_type, doc, id=id, **routing_kwargs(id or doc.get('_id')))
 
     def index_bulk(self, docs, step=None):
         index_name = self._index
         doc_type = self._doc_type
         step = step or self.step
+        self._mark_updated_before_write()
 
         def _get_bulk(doc):
+            add_hg38_id(doc)
             doc.update({
                 "_index": index_name,
                 "_type": doc_type,
             })
+            routing = get_routing(doc.get('_id'))
+            if routing:
+                doc['_routing'] = routing
             return doc
         actions = (_get_bulk(doc) for doc in docs)
         return helpers.bulk(self._es, actions, chunk_size=step)
 
     def delete_doc(self, id):
         '''delete a doc from the index based on passed id.'''
-        return self._es.delete(self._index, self._doc_type, id)
+        return self._es.delete(self._index, self._doc_type, id, **routing_kwargs(id))
 
     def delete_docs(self, ids, step=None):
         '''delete a list of docs in bulk.'''
@@ -189,6 +265,9 @@ class ESIndexer():
                 "_type": doc_type,
                 "_id": _id
             }
+            routing = get_routing(_id)
+            if routing:
+                doc['_routing'] = routing
             return doc
         actions = (_get_bulk(_id) for _id in ids)
         return helpers.bulk(self._es, actions, chunk_size=step, stats_only=True, raise_on_error=False)
@@ -197,10 +276,11 @@ class ESIndexer():
         '''update an existing doc with extra_doc.
            allow to set upsert=True, to insert new docs.
         '''
-        body = {'doc': extra_doc}
+        self._mark_updated_before_write()
+        body = {'doc': add_hg38_id(extra_doc, id)}
         if upsert:
             body['doc_as_upsert'] = True
-        return self._es.update(self._index, self._doc_type, id, body)
+        return self._es.update(self._index, self._doc_type, id, body, **routing_kwargs(id))
 
     def update_docs(self, partial_docs, upsert=True, step=None, **kwargs):
         '''update a list of partial_docs in bulk.
@@ -209,6 +289,7 @@ class ESIndexer():
         index_name = self._index
         doc_type = self._doc_type
         step = step or self.step
+        self._mark_updated_before_write()
 
         def _get_bulk(doc):
             doc = {
@@ -216,8 +297,11 @@ class ESIndexer():
                 "_index": index_name,
                 "_type": doc_type,
                 "_id": doc['_id'],
-                "doc": doc
+                "doc": add_hg38_id(doc)
             }
+            routing = get_routing(doc['_id'])
+            if routing:
+                doc['_routing'] = routing
             if upsert:
                 doc['doc_as_upsert'] = True
             return doc
@@ -243,7 +327,10 @@ class ESIndexer():
         m = m[self._index]['mappings'][self._doc_type]
         return m.get('_meta', {})
 
-    def update_mapping_meta(self, meta, confirm=True):
+    def update_mapping_meta(self, meta, confirm=True, keep_id_filter=True):
+        '''replace the _meta field. The ids in the index are unchanged, so if
+           keep_id_filter is True, an id filter built from the current _meta
+           is saved again with the new one (see build_id_filter).'''
         allowed_keys = set(['_meta', '_timestamp'])
         if isinstance(meta, dict) and len(set(meta) - allowed_keys) == 0:
             current_meta = self.get_mapping_meta()
@@ -258,6 +345,8 @@ class ESIndexer():
                     body=body,
                     index=self._index
                 ))
+                if keep_id_filter and '_meta' in meta:
+                    self._update_id_filter_meta(current_meta, meta['_meta'])
         else:
             raise ValueError('Input "meta" should have and only have "_meta" field.')
 
@@ -316,6 +405,9 @@ class ESIndexer():
 
         if cnt:
             print('Done! - {} docs indexed.'.format(cnt))
+            if getattr(config, 'ID_FILTER_PATH', None):
+                print("Building id filter...")
+                self.build_id_filter(verbose=verbose)
 
             # No longer do optimization after indexing
             # since it does not run async since ES v1.5
@@ -499,6 +591,53 @@ class ESIndexer():
         id_li = [doc['_id'] for doc in cur]
         return id_li
 
+    def mark_updated(self):
+        '''set "updated" in the index _meta to the current time. Call it before
+           adding docs to an existing index: the web nodes only use an id
+           filter built from the current _meta, so they stop using the one
+           built before, until build_id_filter is run again. The web nodes
+           re-read the _meta every BUILD_VERSION_CHECK_INTERVAL seconds.'''
+        meta = self.get_mapping_meta()
+        meta['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._es.indices.put_mapping(index=self._index, doc_type=self._doc_type,
+                                     body={self._doc_type: {'_meta': meta}})
+
+    def _mark_updated_before_write(self):
+        '''mark_updated, if an id filter is used (config.ID_FILTER_PATH).'''
+        if getattr(config, 'ID_FILTER_PATH', None):
+            self.mark_updated()
+
+    def _update_id_filter_meta(self, old_meta, new_meta, path=None):
+        '''save the id filter again with new_meta, if it was built from old_meta.'''
+        path = path or getattr(config, 'ID_FILTER_PATH', None)
+        if not path or not os.path.exists(path):
+            return
+        bf = BloomFilter.load(path)
+        try:
+            if bf.meta == old_meta:
+                bf.save(path, meta=new_meta)
+                print('Saved id filter "{}" with the new _meta.'.format(path))
+        finally:
+            bf.close()
+
+    def build_id_filter(self, path=None, fp_rate=None, step=100000, verbose=True):
+        '''build the Bloom filter of all ids in the index (see utils/bloom.py)
+           and save it to path (config.ID_FILTER_PATH by default). Must be
+           re-built whenever docs are added to the index, e.g. after an
+           incremental update (see mark_updated), since the web nodes answer
+           the ids not in the filter as not found.'''
+        path = path or config.ID_FILTER_PATH
+        fp_rate = fp_rate or getattr(config, 'ID_FILTER_FP_RATE', 0.01)
+        # read _meta first, a build finished meanwhile makes the filter out of date
+        meta = self.get_mapping_meta()
+        bf = BloomFilter(capacity=self.count(), fp_rate=fp_rate)
+        for doc in self.doc_feeder(step=step, _source=False, verbose=verbose):
+            bf.add(doc['_id'])
+        bf.save(path, meta=meta)
+        if verbose:
+            print('Saved Bloom filter of {} ids to "{}" [{} MB].'.format(bf.count, path, round(bf.num_bits / 8. / 1024 ** 2, 1)))
+        return bf
+
     def find_biggest_doc(self, fields_li, min=5, return_doc=False):
         """return the doc with the max number of fields from fields_li."""
         import itertools
@@ -1,12 +1,153 @@
+'''
+Google Analytics tracking of the API requests.
+
+ga_track only puts a hit on a bounded in-memory queue, so it adds no
+latency to the request. A periodic IOLoop callback drains the queue in
+batches and sends them to GA. When the queue is full, new hits are dropped,
+counted as "dropped" in the stats (exported on /metrics) and logged.
+
+What the numbers in GA mean:
+  - pageviews: one per tracked request, as before.
+  - events with a value (e.g. "qsize"): one per tracked request, as before.
+  - events without a value: identical ones (same visitor, path and event)
+    of a batch are sent as one event, whose value is the number of
+    requests. Count these by the sum of event values, not by total events.
+
+Set GA_ENDPOINT in config to send the hits somewhere else than GA,
+e.g. to the stand-in collector in tests/ga_collector.py.
+'''
+from collections import deque, OrderedDict
+import logging
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.ioloop import PeriodicCallback
 from pyga.requests import (Tracker, Page, Session, Visitor,
                            Event, PageViewRequest, EventRequest)
 import config
 
 
+def _to_http_request(ga_request):
+    r = ga_request.build_http_request()
+    return HTTPRequest(r.get_full_url(),
+                       "POST" if (r.data) else "GET",
+                       headers=r.headers,
+                       body=r.data)
+
+
+class GADispatcher():
+    '''queues GA hits and sends them in the background.
+
+       A hit is a (visitor, path, event, value) tuple, where visitor is an
+       (ip, user agent, accept language) tuple and event is a tuple of
+       sorted (name, value) pairs without "value", or None for a pageview
+       only. A pageview is sent per hit, and so is an event with a value.
+       Identical events without a value in a batch are sent once, with the
+       number of hits as value.
+    '''
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=5):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval    # in seconds
+        self._queue = deque()
+        self._periodic_callback = None
+        self.stats = {'queued': 0, 'dropped': 0, 'aggregated': 0, 'sent': 0, 'errors': 0}
+        self._dropped_logged = 0
+
+    def put(self, hit):
+        '''queue a hit, return False if it's dropped because the queue is full.
+           Must be called from the IOLoop thread.'''
+        if len(self._queue) >= self.maxsize:
+            self.stats['dropped'] += 1
+            return False
+        self._queue.append(hit)
+        self.stats['queued'] += 1
+        if self._periodic_callback is None:
+            # started on first use, so it runs on the (worker's) current IOLoop
+            self._periodic_callback = PeriodicCallback(self.flush, self.flush_interval * 1000)
+            self._periodic_callback.start()
+        return True
+
+    def get_batch(self):
+        '''pop up to batch_size hits from the queue, return them grouped as
+           a dictionary of (visitor, path, event) --> [count, values], where
+           values are the event values of the hits having one.'''
+        batch = OrderedDict()
+        n = 0
+        while self._queue and n < self.batch_size:
+            visitor, path, event, value = self._queue.popleft()
+            n += 1
+            item = batch.setdefault((visitor, path, event), [0, []])
+            item[0] += 1
+            if value is not None:
+                item[1].append(value)
+        # events without a value sent as one
+        self.stats['aggregated'] += sum(max(count - len(values) - 1, 0)
+                                        for (_, _, event), (count, values) in batch.items() if event)
+        return batch
+
+    def flush(self):
+        '''send all queued hits, batch by batch.'''
+        dropped = self.stats['dropped'] - self._dropped_logged
+        if dropped:
+            logging.warning('GA queue full, %d hits dropped', dropped)
+            self._dropped_logged += dropped
+        if not self._queue:
+            return
+        tracker = Tracker(config.GA_ACCOUNT, 'MyVariant.info')
+        endpoint = getattr(config, 'GA_ENDPOINT', None)
+        if endpoint:
+            tracker.config.endpoint = endpoint
+        http_client = AsyncHTTPClient()
+        while self._queue:
+            batch = self.get_batch()
+            for (visitor_key, path, event), (count, values) in batch.items():
+                for _req in self.build_requests(tracker, visitor_key, path, event, count, values):
+                    http_client.fetch(_req, callback=self._on_response)
+
+    def build_requests(self, tracker, visitor_key, path, event, count, values):
+        '''return the HTTP requests for count identical hits, see get_batch.'''
+        ip_address, user_agent, accept_language = visitor_key
+        visitor = Visitor()
+        visitor.ip_address = ip_address
+        visitor.user_agent = user_agent
+        #get visitor.locale
+        visitor.extract_from_server_meta({"HTTP_ACCEPT_LANGUAGE": accept_language})
+        session = Session()
+        page = Page(path)
+        _req_list = [_to_http_request(PageViewRequest(config=tracker.config,
+                                                      tracker=tracker,
+                                                      visitor=visitor,
+                                                      session=session,
+                                                      page=page))
+                     for i in range(count)]
+        if event:
+            event_values = list(values)
+            if count > len(values):
+                # the events without a value, as one
+                event_values.append(count - len(values) if count - len(values) > 1 else None)
+            for value in event_values:
+                _event = dict(event)
+                if value is not None:
+                    _event['value'] = value
+                _req_list.append(_to_http_request(EventRequest(config=tracker.config,
+                                                               tracker=tracker,
+                                                               visitor=visitor,
+                                                               session=session,
+                                                               event=Event(**_event))))
+        return _req_list
+
+    def _on_response(self, response):
+        if response.error:
+            self.stats['errors'] += 1
+        else:
+            self.stats['sent'] += 1
+
+ga_dispatcher = GADispatcher(maxsize=getattr(config, 'GA_QUEUE_SIZE', 10000),
+                             batch_size=getattr(config, 'GA_BATCH_SIZE', 500),
+                             flush_interval=getattr(config, 'GA_FLUSH_INTERVAL', 5))
+
+
 class GAMixIn:
     def ga_track(self, event={}):
-        _req_list = []
         no_tracking = self.get_argument('no_tracking', None)
         is_prod = getattr(config, 'RUN_IN_PROD', False)
         if not no_tracking and is_prod and hasattr(config, "GA_ACCOUNT"):
@@ -14,43 +155,12 @@ class GAMixIn:
             remote_ip = _req.headers.get("X-Real-Ip",
                         _req.headers.get("X-Forwarded-For",
                         _req.remote_ip))
-            user_agent = _req.headers.get("User-Agent", None)
-            visitor = Visitor()
-            visitor.ip_address = remote_ip
-            visitor.user_agent = user_agent
-            #get visitor.locale
-            visitor.extract_from_server_meta(
-                {"HTTP_ACCEPT_LANGUAGE": _req.headers.get("Accept-Language", None)}
-            )
-            session = Session()
-            page = Page(_req.path)
-            tracker = Tracker(config.GA_ACCOUNT, 'MyVariant.info')
-            # tracker.track_pageview(page, session, visitor)  #this is non-async request
-            pvr = PageViewRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  page=page)
-            r = pvr.build_http_request()
-            _req_list.append(HTTPRequest(r.get_full_url(),
-                                         "POST" if (r.data) else "GET",
-                                         headers=r.headers,
-                                         body=r.data))
+            visitor = (remote_ip,
+                       _req.headers.get("User-Agent", None),
+                       _req.headers.get("Accept-Language", None))
             if event:
-                evt = Event(**event)
-                #tracker.track_event(evt, session, visitor)  #this is non-async request
-                er = EventRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  event=evt)
-                r = er.build_http_request()
-                _req_list.append(HTTPRequest(r.get_full_url(),
-                                             "POST" if (r.data) else "GET",
-                                             headers=r.headers,
-                                             body=r.data))
-
-            #now send actual async requests
-            http_client = AsyncHTTPClient()
-            for _req in _req_list:
-                http_client.fetch(_req)
+                value = event.get('value', None)
+                event = tuple(sorted((k, v) for k, v in event.items() if k != 'value'))
+            else:
+                value, event = None, None
+            ga_dispatcher.put((visitor, _req.path, event, value))
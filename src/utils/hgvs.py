@@ -1,6 +1,94 @@
 import re
 import copy
-import requests
+
+from utils.cache import LRUCache
+
+HGVS_CHROM_PATTERN = re.compile(r'^chr(\w+):')
+# patterns used by canonicalize_hgvs
+_HGVS_PREFIX_PATTERN = re.compile(r'^\s*(?:chr)?(?P<chrom>\d{1,2}|X|Y|MT?)\s*:\s*(?:g\.?|\.g?)?\s*(?P<change>\d.*?)\s*$', re.I)
+_HGVS_SNP_PATTERN = re.compile(r'^(?P<pos>\d+)(?P<ref>[ACGTN]+|-)>(?P<alt>[ACGTN]+|-)$', re.I)
+_HGVS_INDEL_PATTERN = re.compile(r'^(?P<pos>\d+(?:_\d+)?)(?P<type>delins|del|ins|dup)(?P<seq>[ACGTN]*)$', re.I)
+_canonical_hgvs_cache = LRUCache(maxsize=100000)
+
+
+def normalize_chrom(chrom):
+    '''return chrom as in hgvs ids, e.g. "chrx" or "x" --> "X", "M" --> "MT".'''
+    chrom = chrom.upper()
+    if chrom.startswith('CHR'):
+        chrom = chrom[3:]
+    return 'MT' if chrom == 'M' else chrom
+
+
+def _canonicalize_change(change):
+    mat = _HGVS_SNP_PATTERN.match(change)
+    if mat:
+        pos, ref, alt = mat.group('pos'), mat.group('ref').upper(), mat.group('alt').upper()
+        if ref == '-' and alt != '-':
+            # insertion, e.g. "->T", see fix_hgvs_indel
+            return '{}_{}ins{}'.format(pos, int(pos) + 1, alt)
+        elif alt == '-' and ref != '-':
+            # deletion, e.g. "C>-"
+            end = int(pos) + len(ref) - 1
+            return '{}del'.format(pos) if end == int(pos) else '{}_{}del'.format(pos, end)
+        return '{}{}>{}'.format(pos, ref, alt)
+    mat = _HGVS_INDEL_PATTERN.match(change)
+    if mat:
+        return mat.group('pos') + mat.group('type').lower() + mat.group('seq').upper()
+    return change
+
+
+def _canonicalize_hgvs(hgvs_id):
+    mat = _HGVS_PREFIX_PATTERN.match(hgvs_id)
+    if not mat:
+        return hgvs_id.strip()
+    return 'chr{}:g.{}'.format(normalize_chrom(mat.group('chrom')),
+                               _canonicalize_change(mat.group('change')))
+
+
+def canonicalize_hgvs(hgvs_id):
+    """return the hgvs id as the _ids in the index, fixing common variations:
+         'chr1:G.35367g>a', '1:g.35367G>A', 'chr1:35367G>A'  --> 'chr1:g.35367G>A'
+         'chrM:g.8993T>G'                                     --> 'chrMT:g.8993T>G'
+         'chr19:g.58863869C>-'                                --> 'chr19:g.58863869del'
+         'chr10:g.52596077->T'                                --> 'chr10:g.52596077_52596078insT'
+       ids not starting with a chromosome (e.g. rsids) are returned unchanged
+       (but stripped). Results are cached, so it's cheap to call per request.
+    """
+    if not hgvs_id:
+        return hgvs_id
+    _hgvs_id = _canonical_hgvs_cache.get(hgvs_id)
+    if _hgvs_id is None:
+        _hgvs_id = _canonicalize_hgvs(hgvs_id)
+        _canonical_hgvs_cache.set(hgvs_id, _hgvs_id)
+    return _hgvs_id
+
+
+def shift_hgvs(hgvs_id, start):
+    """return hgvs_id with its position moved to start, keeping the change,
+       e.g. to get the hg38 id of a variant from its (hg19) _id and hg38 start:
+         shift_hgvs('chr1:g.35367G>A', 100)        --> 'chr1:g.100G>A'
+         shift_hgvs('chr1:g.35367_35369del', 100)  --> 'chr1:g.100_102del'
+       return None if hgvs_id is not a genomic hgvs id.
+    """
+    mat = _HGVS_PREFIX_PATTERN.match(hgvs_id)
+    if not mat:
+        return
+    change = _canonicalize_change(mat.group('change'))
+    pos_mat = re.match(r'(\d+)(?:_(\d+))?', change)
+    start = int(start)
+    if pos_mat.group(2):
+        pos = '{}_{}'.format(start, start + int(pos_mat.group(2)) - int(pos_mat.group(1)))
+    else:
+        pos = str(start)
+    return 'chr{}:g.{}{}'.format(normalize_chrom(mat.group('chrom')), pos, change[pos_mat.end():])
+
+
+def get_hgvs_chrom(hgvs_id):
+    '''return the chromosome of a hgvs id (e.g. "1", "X", "MT"),
+       or None if it does not start with "chr<chrom>:".'''
+    mat = HGVS_CHROM_PATTERN.match(hgvs_id) if hgvs_id else None
+    if mat:
+        return normalize_chrom(mat.group(1))
 
 
 def is_snp(hgvs_id):
@@ -187,6 +275,7 @@ def get_hgvs_from_rsid(doc_li, rsid_fn, api_host='http://localhost:8000'):
        It will return a generator with the _id as the matching hgvs_id for a given rsid.
        if a rsid matches multiple hgvs ids, it will produce duplicated docs with each hgvs id.
     """
+    import requests    # only needed here, not a web node requirement
     for doc in doc_li:
         rsid = rsid_fn(doc)
         # parse from myvariant.info to get hgvs_id, ref, alt information based on rsid
@@ -0,0 +1,132 @@
+'''
+Request latency metrics of the web nodes, exposed in the Prometheus text
+format (see www/index.py MetricsHandler).
+
+Each request gets a StageTimer, which accumulates the time spent in each
+stage (ES, post-processing, encoding...). When the request finishes, its
+total and per-stage times are added to histograms per endpoint:
+
+    timer = StageTimer()
+    with timed(timer, 'encode'):
+        ...
+    metrics.observe_request('variant_get', total_time, timer)
+
+Metrics are kept per process, so with multiple worker processes each
+worker reports its own.
+'''
+import time
+import threading
+from contextlib import contextmanager
+
+# histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class StageTimer():
+    '''accumulates the time (in seconds) spent in each named stage of a request.
+       Stages can be timed from several threads (e.g. concurrent ES batches).'''
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+
+@contextmanager
+def timed(timer, stage):
+    '''time the enclosed block as stage on timer, does nothing if timer is None.'''
+    if timer is None:
+        yield
+        return
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        timer.add(stage, time.time() - t0)
+
+
+class Histogram():
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for le, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), self.sum))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), self.count))
+        return lines
+
+
+def format_labels(labels):
+    '''format a tuple of (name, value) pairs as {name="value",...}.'''
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class MetricsRegistry():
+    '''holds the latency histograms and renders them as Prometheus text.'''
+    REQUEST_METRIC = 'myvariant_request_duration_seconds'
+    STAGE_METRIC = 'myvariant_request_stage_duration_seconds'
+    HELP = {
+        REQUEST_METRIC: 'Total time to serve an API request.',
+        STAGE_METRIC: 'Time spent per API request in each stage (es_request, es_took, es_network, postprocess, encode, ga).'
+    }
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}    # metric name --> {labels: Histogram}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if labels not in histograms:
+                histograms[labels] = Histogram(self.buckets)
+            histograms[labels].observe(value)
+
+    def observe_request(self, endpoint, total, timer=None):
+        self.observe(self.REQUEST_METRIC, (('endpoint', endpoint),), total)
+        if timer:
+            for stage, seconds in timer.stages.items():
+                self.observe(self.STAGE_METRIC, (('endpoint', endpoint), ('stage', stage)), seconds)
+
+    def render(self):
+        '''return all histograms in the Prometheus text exposition format.'''
+        lines = []
+        with self._lock:
+            for name in sorted(self._histograms):
+                lines.append('# HELP {} {}'.format(name, self.HELP.get(name, name)))
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels in sorted(self._histograms[name]):
+                    lines.extend(self._histograms[name][labels].render(name, labels))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+metrics = MetricsRegistry()
+
+
+def format_metric(name, samples, metric_type='gauge', help=None):
+    '''return the lines of a gauge/counter in Prometheus text format,
+       samples is a list of (labels, value) pairs.'''
+    lines = ['# HELP {} {}'.format(name, help or name),
+             '# TYPE {} {}'.format(name, metric_type)]
+    for labels, value in samples:
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    return lines
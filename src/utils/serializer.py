@@ -0,0 +1,53 @@
+'''
+Response serializers used by the web nodes.
+
+JSON keys are sorted by the encoder itself, no sorted copy of the (often
+large) response object is made. Output is compact unless an indent is
+given, as json.dumps with an indent falls back to its much slower pure
+python encoder. msgpack has no such option, so msgpack responses are
+copied with their keys in order before being packed.
+'''
+import json
+import datetime
+from collections import OrderedDict
+
+try:
+    import msgpack
+    SUPPORT_MSGPACK = True
+except ImportError:
+    SUPPORT_MSGPACK = False
+
+
+class DateTimeJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        else:
+            return super(DateTimeJSONEncoder, self).default(obj)
+
+
+def msgpack_encode_datetime(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': True, 'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")}
+    return obj
+
+
+def to_json(data, indent=None):
+    '''return data as a JSON string with sorted keys, pretty-printed if indent is set.'''
+    if indent:
+        return json.dumps(data, cls=DateTimeJSONEncoder, sort_keys=True, indent=indent)
+    return json.dumps(data, cls=DateTimeJSONEncoder, sort_keys=True, separators=(',', ':'))
+
+
+def _key_sorted(data):
+    '''return a copy of data with the keys of every dict in sorted order.'''
+    if isinstance(data, dict):
+        return OrderedDict((k, _key_sorted(data[k])) for k in sorted(data))
+    if isinstance(data, (list, tuple)):
+        return [_key_sorted(item) for item in data]
+    return data
+
+
+def to_msgpack(data):
+    '''return data as msgpack bytes, with sorted map keys as in to_json.'''
+    return msgpack.packb(_key_sorted(data), use_bin_type=True, default=msgpack_encode_datetime)
@@ -1,54 +1,205 @@
+import os
 import re
 import json
-from utils.common import dotdict, is_str, is_seq, find_doc
-from utils.es import get_es
+import math
+import base64
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future, run_on_executor
+from tornado.ioloop import IOLoop
+from utils.common import dotdict, is_str, is_seq
+from utils.es import get_es, get_raw_es, get_routing, get_chrom_routing, routing_kwargs
+from utils.cache import LRUCache
+from utils.hgvs import canonicalize_hgvs
+from utils.bloom import BloomFilter
+from dataindex.mapping import HG38_ID_FIELD, HG19_FIELDS, HG38_FIELDS, CHROM_FIELDS, INTERNAL_FIELDS
+from utils.metrics import timed
+from .fields import FieldTable
 from elasticsearch import NotFoundError, RequestError
 import config
 
 # a query to get variants with most of fields:
 # _exists_:dbnsfp AND _exists_:dbsnp AND _exists_:mutdb AND _exists_:cosmic AND _exists_:clinvar AND _exists_:gwassnps
 
-HG38_FIELDS = ['clinvar.hg38', 'dbnsfp.hg38', 'evs.hg38']
-HG19_FIELDS = ['clinvar.hg19', 'cosmic.hg19', 'dbnsfp.hg19', 'dbsnp.hg19', 'docm.hg19', 'evs.hg19', 'grasp.hg19'] #, 'mutdb.hg19', 'wellderly.hg19']
-CHROM_FIELDS = ['cadd.chrom', 'clinvar.chrom', 'cosmic.chrom', 'dbnsfp.chrom', 'dbsnp.chrom', 'docm.chrom',
-                'evs.chrom', 'exac.chrom']#, 'mutdb.chrom', 'wellderly.chrom']
+# max number of in-flight ES requests per process: the size of the
+# AsyncESQuery thread pool and of the shared ES connection pool
+ES_ASYNC_WORKERS = getattr(config, 'ES_ASYNC_WORKERS', 100)
 
 
 class MVQueryError(Exception):
     pass
 
 
-class MVScrollSetupError(Exception):
-    pass
+def get_build_version(meta):
+    '''return a version string identifying the index build from its _meta field.
+       "build_version" is used if available, otherwise a hash of the whole _meta.
+       Return None if there is no _meta, the build cannot be identified then.
+    '''
+    if not meta:
+        return None
+    if meta.get('build_version'):
+        return str(meta['build_version'])
+    return hashlib.md5(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_build_timestamp(meta):
+    '''return the "timestamp" of the index _meta field as a datetime, or None.'''
+    try:
+        return datetime.datetime.strptime(meta['timestamp'][:19], '%Y-%m-%dT%H:%M:%S')
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+_SOURCE_KEY = '"_source":'
+_ID_PATTERN = re.compile(r'"_id":("(?:[^"\\]|\\.)*")')
+_VERSION_PATTERN = re.compile(r'"_version":(\d+)')
+_TOOK_PATTERN = re.compile(r'\{"took":(\d+),')    # the first key of a raw search response
+# the HG38_ID_FIELD key of a _source, with the comma before or after it
+_HG38_ID_PATTERN = re.compile(r'"{0}"\s*:\s*"(?:[^"\\]|\\.)*"\s*,?|,\s*"{0}"\s*:\s*"(?:[^"\\]|\\.)*"'.format(HG38_ID_FIELD))
+
+
+def splice_variantdoc(res):
+    """return the variant doc from a raw (JSON string) ES get response by
+       hoisting its _source, i.e. the same doc as ESQuery._get_variantdoc
+       without decoding it:
+           {"_index":...,"_id":"chr1:g.1A>C","_version":1,"found":true,"_source":{"a":1}}
+       --> {"_id":"chr1:g.1A>C","_version":1,"a":1}
+       Return None if the doc may need post-processing (a "cadd" key anywhere,
+       for the CADD license), or the response is not in the expected format.
+    """
+    i = res.find(_SOURCE_KEY)
+    if i < 0 or not res.endswith('}}'):
+        return None
+    head, source = res[:i], res[i + len(_SOURCE_KEY):-1].strip()
+    if '"cadd"' in source:
+        return None
+    if '"{}"'.format(HG38_ID_FIELD) in source:
+        source = _HG38_ID_PATTERN.sub('', source, count=1)
+    _id, version = _ID_PATTERN.search(head), _VERSION_PATTERN.search(head)
+    if not (_id and version and source.startswith('{')):
+        return None
+    source = source[1:-1].strip()
+    return '{{"_id":{},"_version":{}{}}}'.format(_id.group(1), version.group(1),
+                                                  ',' + source if source else '')
+
+
+# sort values of a hit missing the sort field (ES sorts them last),
+# for string, integer and floating point fields.
+MISSING_SORT_VALUES = (None, 2 ** 63 - 1, -2 ** 63, float('inf'), float('-inf'))
+# "after" value to get the first page of a sorted query along with its "next" token
+FIRST_PAGE_CURSOR = 'start'
+
+
+def encode_cursor(sort, values):
+    '''return the opaque "next" token of a sorted query: its sort option
+       and the sort values of the last hit.'''
+    token = base64.urlsafe_b64encode(json.dumps([sort, values]).encode('utf-8')).decode('ascii')
+    return token.rstrip('=')    # no padding to escape in URLs
+
+
+def decode_cursor(token):
+    '''return (sort, values) from a token made by encode_cursor.'''
+    try:
+        token = str(token)
+        sort, values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise MVQueryError('Invalid "after" parameter.')
+    return sort, values
+
+
+def compile_jsonld_context(context):
+    '''compile the jsonld context (loaded from config.JSONLD_CONTEXT_PATH) into
+       a path trie, so it can be applied to a doc in a single traversal.
+       Each node is a dict of {"context": <dict to insert or None>,
+                               "children": {<key>: <node>}},
+       e.g. "clinvar/rcv" context is at root["children"]["clinvar"]["children"]["rcv"].
+    '''
+    root = {'context': context.get('root'), 'children': {}}
+    for path in context:
+        if path == 'root':
+            continue
+        node = root
+        for key in path.split('/'):
+            node = node['children'].setdefault(key, {'context': None, 'children': {}})
+        node['context'] = context[path]
+    return root
+
+
+_jsonld_trie = None
+
+
+def get_jsonld_trie():
+    '''return the compiled jsonld context, the context file is only
+       loaded the first time it's needed.'''
+    global _jsonld_trie
+    if _jsonld_trie is None:
+        with open(config.JSONLD_CONTEXT_PATH, 'r') as in_f:
+            _jsonld_trie = compile_jsonld_context(json.load(in_f))
+    return _jsonld_trie
+
+
+def apply_jsonld_context(doc, node):
+    '''insert the jsonld context from a compiled trie node into doc in place.
+       a list is treated as multiple docs at the same path.
+    '''
+    if isinstance(doc, dict):
+        if node['context']:
+            doc.update(node['context'])
+        for key, child in node['children'].items():
+            if key in doc:
+                apply_jsonld_context(doc[key], child)
+    elif isinstance(doc, list):
+        for _doc in doc:
+            apply_jsonld_context(_doc, node)
 
 
 class ESQuery():
-    def __init__(self, index=None, doc_type=None, es_host=None, _use_hg38=False):
-        self._es = get_es(es_host)
+    def __init__(self, index=None, doc_type=None, es_host=None, _use_hg38=False, **es_kwargs):
+        self._es = get_es(es_host, **es_kwargs)
+        self._raw_es = get_raw_es(es_host, **es_kwargs)     # for passthrough requests
         self._index = index or config.ES_INDEX_NAME
         self._doc_type = doc_type or config.ES_DOC_TYPE
         self._allowed_options = ['_source', 'start', 'from_', 'size',
                                  'sort', 'explain', 'version', 'facets', 'fetch_all', 'jsonld']  # , 'host']
         self._scroll_time = '1m'
-        self._total_scroll_size = 1000   # Total number of hits to return per scroll batch
-        self._hg38 = _use_hg38
-        self._jsonld = False
-        self._context = json.loads(open(config.JSONLD_CONTEXT_PATH, 'r').read())
-        if self._total_scroll_size % self.get_number_of_shards() == 0:
-            # Total hits per shard per scroll batch
-            self._scroll_size = int(self._total_scroll_size / self.get_number_of_shards())
-        else:
-            raise MVScrollSetupError("_total_scroll_size of {} can't be ".format(self._total_scroll_size) +
-                                     "divided evenly among {} shards.".format(self.get_number_of_shards()))
-
-    def _use_hg38(self):
-        self._hg38 = True
+        self._fetch_all_page_size = getattr(config, 'FETCH_ALL_PAGE_SIZE', 1000)   # hits per scroll batch
+        self._hg38 = _use_hg38     # the default assembly, if "assembly" is not passed
+        self._number_of_shards = None     # see self.number_of_shards
+        # cache for get_variant results, cleared when the index is rebuilt
+        self._variant_cache = LRUCache(maxsize=getattr(config, 'VARIANT_CACHE_SIZE', 10000),
+                                       ttl=getattr(config, 'VARIANT_CACHE_TTL', 3600))
+        self._build_meta = None
+        self._build_version = None
+        self._build_version_checked = 0     # timestamp of the last _meta check
+        self._build_version_check_interval = getattr(config, 'BUILD_VERSION_CHECK_INTERVAL', 60)
+        self._field_table = None    # FieldTable of the current build version
+        self._has_position_fields = False    # if the index has canonical "chrom", "hg19" and "hg38" fields
+        self._has_hg38_ids = False    # if the index has the hg38 id field (HG38_ID_FIELD)
+        # Bloom filter of the ids in the index, see utils/bloom.py
+        self._id_filter_path = getattr(config, 'ID_FILTER_PATH', None)
+        self._id_filter = None
+        self._id_filter_mtime = None
+        self._id_filter_skipped = 0     # ids answered as not found without ES
 
-    def _use_hg19(self):
-        self._hg38 = False
+    def _get_slice_preference(self, slice_id, slices):
+        '''return the "preference" search parameter restricting a fetch_all
+           query to one of its slices: slice <slice_id> of <slices> is made of
+           the shards whose number modulo slices is slice_id. ES 2.x has no
+           sliced scroll, so each slice is a scroll over its own shards.'''
+        if not 1 <= slices <= self.number_of_shards:
+            raise MVQueryError('"slices" must be between 1 and the number of shards ({}).'.format(self.number_of_shards))
+        if not 0 <= slice_id < slices:
+            raise MVQueryError('"slice" must be between 0 and {}.'.format(slices - 1))
+        shards = range(slice_id, self.number_of_shards, slices)
+        return '_shards:' + ','.join(str(shard) for shard in shards)
 
-    def _get_variantdoc(self, hit):
+    def _get_variantdoc(self, hit, options):
         doc = hit.get('_source', hit.get('fields', {}))
+        doc.pop(HG38_ID_FIELD, None)    # only for lookups, see dataindex/mapping.py
         doc.setdefault('_id', hit['_id'])
         for attr in ['_score', '_version']:
             if attr in hit:
@@ -60,37 +211,16 @@ class ESQuery():
         # add cadd license info
         if 'cadd' in doc:
             doc['cadd']['_license'] = 'http://goo.gl/bkpNhq'
-        if self._jsonld:
+        if options.jsonld:
             doc = self._insert_jsonld(doc)
         return doc
 
     def _insert_jsonld(self, k):
         ''' Insert the jsonld links into this document.  Called by _get_variantdoc. '''
-        # get the context
-        context = self._context
-
-        # set the root
-        k.update(context['root'])
-
-        for key in context:
-            if key != 'root':
-                keys = key.split('/')
-                try:
-                    doc = find_doc(k, keys)
-                    if type(doc) == list:
-                        for _d in doc:
-                            _d.update(context[key])
-                    elif type(doc) == dict:
-                        doc.update(context[key])
-                    else:
-                        continue
-                        #print('error')
-                except:
-                    continue
-                    #print('keyerror')
+        apply_jsonld_context(k, get_jsonld_trie())
         return k
 
-    def _cleaned_res(self, res, empty=[], error={'error': True}, single_hit=False):
+    def _cleaned_res(self, res, options, empty=[], error={'error': True}, single_hit=False):
         '''res is the dictionary returned from a query.
            do some reformating of raw ES results before returning.
 
@@ -104,11 +234,16 @@ class ESQuery():
         if total == 0:
             return empty
         elif total == 1 and single_hit:
-            return self._get_variantdoc(hits['hits'][0])
+            return self._get_variantdoc(hits['hits'][0], options)
         else:
-            return [self._get_variantdoc(hit) for hit in hits['hits']]
+            return [self._get_variantdoc(hit, options) for hit in hits['hits']]
+
+    def _empty_res(self, options):
+        '''return a query result without hits, as returned by ES if options.raw.'''
+        res = {'took': 0, 'hits': {'total': 0, 'max_score': None, 'hits': []}}
+        return res if options.raw else self._clean_res2(res, options)
 
-    def _clean_res2(self, res):
+    def _clean_res2(self, res, options):
         '''res is the dictionary returned from a query.
            do some reformating of raw ES results before returning.
 
@@ -118,7 +253,7 @@ class ESQuery():
         for attr in ['took', 'facets', 'aggregations', '_scroll_id']:
             if attr in res:
                 _res[attr] = res[attr]
-        _res['hits'] = [self._get_variantdoc(hit) for hit in _res['hits']]
+        _res['hits'] = [self._get_variantdoc(hit, options) for hit in _res['hits']]
         return _res
 
     def _cleaned_scopes(self, scopes):
@@ -170,14 +305,28 @@ class ESQuery():
         return options
 
     def _get_cleaned_query_options(self, kwargs):
-        """common helper for processing fields, kwargs and other options passed to ESQueryBuilder."""
+        """common helper for processing fields, kwargs and other options passed to ESQueryBuilder.
+           The returned options hold all the per-request settings and are passed
+           along the call, nothing is stored on self, so one ESQuery instance can
+           serve concurrent requests.
+        """
         options = dotdict()
         options.raw = kwargs.pop('raw', False)
         options.rawquery = kwargs.pop('rawquery', False)
         options.fetch_all = kwargs.pop('fetch_all', False)
+        # for fetch_all, get slice <slice> of <slices> (see _get_slice_preference)
+        options.slice = kwargs.pop('slice', 0)
+        options.slices = kwargs.pop('slices', None)
+        # for fetch_all, if the first response has the first page of hits
+        options.first_page = kwargs.pop('first_page', False)
+        # the "next" token of the previous page, see self._set_cursor
+        options.after = kwargs.pop('after', None)
         options.jsonld = kwargs.pop('jsonld', False)
-        self._jsonld = options.jsonld
+        options.hg38 = self._use_hg38(kwargs.pop('assembly', None))
         options.host = kwargs.pop('host', 'myvariant.info')
+        options.timer = kwargs.pop('timer', None)
+        # if the result can be a JSON string, passed through from ES undecoded
+        options.passthrough = kwargs.pop('passthrough', False)
         scopes = kwargs.pop('scopes', None)
         if scopes:
             options.scopes = self._cleaned_scopes(scopes)
@@ -192,40 +341,233 @@ class ESQuery():
         options.kwargs = kwargs
         return options
 
+    def _use_hg38(self, assembly=None):
+        return assembly.lower() == 'hg38' if assembly else self._hg38
+
+    def _timed_es_call(self, options, es_method, *args, **kwargs):
+        '''call es_method, recording on options.timer its wall time as the
+           "es_request" stage, and if ES reports it, the "took" time as
+           "es_took" and the remainder (network, (de)serializing) as "es_network".
+           The response can be a raw JSON string (passthrough). ES reports no
+           "took" for get and mget requests, those only have "es_request".
+        '''
+        timer = options.timer
+        if timer is None:
+            return es_method(*args, **kwargs)
+        t0 = time.time()
+        res = es_method(*args, **kwargs)
+        elapsed = time.time() - t0
+        timer.add('es_request', elapsed)
+        took = None
+        if is_str(res):
+            mat = _TOOK_PATTERN.match(res)
+            if mat:
+                took = int(mat.group(1))
+        elif isinstance(res, dict):
+            if 'took' in res:
+                took = res['took']
+            elif 'responses' in res:
+                took = max([r.get('took', 0) for r in res['responses']] or [0])
+        if took is not None:
+            timer.add('es_took', took / 1000.)
+            timer.add('es_network', max(elapsed - took / 1000., 0))
+        return res
+
     def get_number_of_shards(self):
         r = self._es.indices.get_settings(self._index)
         n_shards = r[list(r.keys())[0]]['settings']['index']['number_of_shards']
         n_shards = int(n_shards)
         return n_shards
 
+    @property
+    def number_of_shards(self):
+        '''cached number of shards of the index, only requested from ES once.'''
+        if self._number_of_shards is None:
+            self._number_of_shards = self.get_number_of_shards()
+        return self._number_of_shards
+
     def exists(self, vid):
-        """return True/False if a variant id exists or not."""
-        try:
-            doc = self.get_variant(vid, fields=None)
-            return doc['found']
-        except NotFoundError:
+        """return True/False if a variant id exists or not.
+           It's a HEAD request, the doc itself is not fetched."""
+        vid = canonicalize_hgvs(vid)
+        self._check_build_version()
+        if self._is_missing(vid):
             return False
+        return self._es.exists(index=self._index, doc_type=self._doc_type, id=vid, **routing_kwargs(vid))
+
+    def mexists(self, vid_list, **kwargs):
+        """return a list of True/False, one per id in vid_list, if a variant
+           matching it exists. No doc is fetched: an mget without _source for
+           "_id" scopes (the default), otherwise an msearch with size 0 that
+           stops at the first match on each shard (terminate_after).
+           With assembly=hg38, ids are hg38 ids, matched on HG38_ID_FIELD.
+        """
+        options = self._get_cleaned_query_options(kwargs)
+        _vid_list = vid_list
+        if options.scopes in (None, '_id') and options.hg38:
+            self._check_build_version()
+            if self._has_hg38_ids:
+                options.scopes = HG38_ID_FIELD
+                _vid_list = [canonicalize_hgvs(vid) for vid in vid_list]
+        if options.scopes in (None, '_id'):
+            _ids = [canonicalize_hgvs(vid) for vid in vid_list if vid]
+            self._check_build_version()
+            _ids = [vid for vid in _ids if not self._is_missing(vid)]
+            _routings = [get_routing(vid) for vid in _ids]
+            if any(_routings):
+                _q = {'docs': [dict({'_id': vid}, **({'_routing': routing} if routing else {}))
+                               for vid, routing in zip(_ids, _routings)]}
+            else:
+                _q = {'ids': _ids}
+            if options.rawquery:
+                return _q
+            found = set()
+            if _ids:
+                res = self._timed_es_call(options, self._es.mget, body=_q, index=self._index,
+                                          doc_type=self._doc_type, _source=False)
+                found = set(doc['_id'] for doc in res['docs'] if doc.get('found'))
+            return [bool(vid) and canonicalize_hgvs(vid) in found for vid in vid_list]
+
+        qbdr = ESQueryBuilder(size=0, terminate_after=1)
+        _q = qbdr.build_multiple_id_query(_vid_list, scopes=options.scopes)
+        if options.rawquery:
+            return _q
+        res = self._timed_es_call(options, self._es.msearch, body=_q, index=self._index,
+                                  doc_type=self._doc_type)['responses']
+        assert len(res) == len(vid_list)
+        return ['error' not in r and r['hits']['total'] > 0 for r in res]
+
+    def _build_meta_is_fresh(self):
+        return time.time() - self._build_version_checked <= self._build_version_check_interval
+
+    def _check_build_version(self):
+        '''re-read the index _meta if it has not been checked recently, so that
+           cached results are dropped after the index is rebuilt.'''
+        if not self._build_meta_is_fresh():
+            self.get_mapping_meta()
+
+    def _set_build_version(self, meta):
+        version = get_build_version(meta)
+        if version != self._build_version:
+            self._variant_cache.clear()
+            self._field_table = None
+            self._build_version = version
+        self._build_meta = meta
+        self._build_version_checked = time.time()
+        self._load_id_filter()
+
+    def _load_id_filter(self):
+        '''(re)load the id filter if its file has changed since last loaded.'''
+        if not self._id_filter_path:
+            return
+        try:
+            mtime = os.path.getmtime(self._id_filter_path)
+        except OSError:
+            self._id_filter, self._id_filter_mtime = None, None
+            return
+        if mtime != self._id_filter_mtime:
+            try:
+                id_filter = BloomFilter.load(self._id_filter_path)
+            except (IOError, ValueError) as e:
+                logging.warning('Cannot load id filter: %s', e)
+                id_filter = None
+            # the old one is not closed, it may still be read by other threads
+            self._id_filter, self._id_filter_mtime = id_filter, mtime
+
+    def _get_id_filter(self):
+        '''return the id filter if it was built from the current index _meta,
+           otherwise None: it may miss ids indexed since, by a new build or an
+           incremental update (see ESIndexer.mark_updated).'''
+        id_filter = self._id_filter
+        if (id_filter is not None and self._build_version is not None and
+                id_filter.meta == self._build_meta):
+            return id_filter
+
+    def _is_missing(self, vid):
+        '''return True if vid is definitely not in the index, according to the
+           id filter. It does not check the build version, call
+           self._check_build_version() first.'''
+        id_filter = self._get_id_filter()
+        if id_filter is not None and vid not in id_filter:
+            self._id_filter_skipped += 1
+            return True
+        return False
+
+    def get_build_meta(self):
+        '''return the index _meta field, only re-read from ES if it has not been
+           checked in the last BUILD_VERSION_CHECK_INTERVAL seconds.'''
+        self._check_build_version()
+        return self._build_meta
+
+    def get_cache_stats(self):
+        '''return hit/miss counters of the get_variant cache.'''
+        stats = self._variant_cache.stats()
+        stats['build_version'] = self._build_version
+        id_filter = self._get_id_filter()
+        stats['id_filter'] = {'active': id_filter is not None,
+                              'ids': len(id_filter) if id_filter is not None else 0,
+                              'skipped': self._id_filter_skipped}
+        return stats
 
     def get_variant(self, vid, **kwargs):
-        '''unknown vid return None'''
+        '''unknown vid return None, vid is canonicalized first (see canonicalize_hgvs).
+           With passthrough option, the doc can be returned as a JSON string,
+           spliced from the ES response without decoding it (see splice_variantdoc).
+           With assembly=hg38, vid is an hg38 id, looked up on HG38_ID_FIELD.
+        '''
+        vid = canonicalize_hgvs(vid)
         options = self._get_cleaned_query_options(kwargs)
         kwargs = {"_source": options.kwargs["_source"]} if "_source" in options.kwargs else {}
+        kwargs.update(routing_kwargs(vid))    # an hg38 id is on the same chromosome
+        if options.hg38 or not options.raw:
+            self._check_build_version()
+        hg38 = options.hg38 and self._has_hg38_ids
+        passthrough = options.passthrough and (options.raw or not options.jsonld) and not hg38
+        # without a build version, cached docs could not be dropped after a rebuild
+        use_cache = not options.raw and self._build_version is not None
+        if use_cache:
+            fields = kwargs.get('_source', None)
+            cache_key = (vid, tuple(fields) if is_seq(fields) else fields, options.hg38, bool(options.jsonld), passthrough)
+            res = self._variant_cache.get(cache_key)
+            if res is not None:
+                return res
+        if not (options.raw or hg38) and self._is_missing(vid):
+            return
         try:
-            res = self._es.get(index=self._index, id=vid, doc_type=self._doc_type, **kwargs)
+            if hg38:
+                res = self._timed_es_call(options, self._es.search, index=self._index, doc_type=self._doc_type,
+                                          body=ESQueryBuilder().build_hg38_id_query(vid),
+                                          size=1, version=True, **kwargs)
+            else:
+                es = self._raw_es if passthrough else self._es
+                res = self._timed_es_call(options, es.get, index=self._index, id=vid, doc_type=self._doc_type, **kwargs)
         except NotFoundError:
             return
 
         if options.raw:
             return res
 
-        res = self._get_variantdoc(res)
+        if hg38:
+            if not res['hits']['hits']:
+                return
+            res = res['hits']['hits'][0]
+            res.pop('_score', None)    # same as the doc from a get
+        with timed(options.timer, 'postprocess'):
+            if passthrough:
+                doc = splice_variantdoc(res)
+                res = json.loads(res) if doc is None else doc
+            if not is_str(res):
+                res = self._get_variantdoc(res, options)
+        if use_cache:
+            # cached docs are shared by requests, so they must not be modified.
+            self._variant_cache.set(cache_key, res)
         return res
 
     def mget_variants(self, vid_list, **kwargs):
         options = self._get_cleaned_query_options(kwargs)
         kwargs = {"_source": options.kwargs["_source"]} if "_source" in options.kwargs else {}
         res = self._es.mget(body={'ids': vid_list}, index=self._index, doc_type=self._doc_type, **kwargs)
-        return res if options.raw else [self._get_variantdoc(doc) for doc in res['docs']]
+        return res if options.raw else [self._get_variantdoc(doc, options) for doc in res['docs']]
 
     def get_variant2(self, vid, **kwargs):
         options = self._get_cleaned_query_options(kwargs)
@@ -235,31 +577,43 @@ class ESQuery():
             return _q
         res = self._es.search(body=_q, index=self._index, doc_type=self._doc_type)
         if not options.raw:
-            res = self._cleaned_res(res, empty=None, single_hit=True)
+            res = self._cleaned_res(res, options, empty=None, single_hit=True)
         return res
 
     def mget_variants2(self, vid_list, **kwargs):
         '''for /query post request'''
         options = self._get_cleaned_query_options(kwargs)
+        _vid_list = vid_list
+        if options.scopes in (None, '_id'):
+            if options.hg38:
+                self._check_build_version()
+            if not (options.hg38 and self._has_hg38_ids):
+                return self._mget_variants_by_id(vid_list, options)
+            # hg38 ids are matched on their own field, in a search per id
+            options.scopes = HG38_ID_FIELD
+            _vid_list = [canonicalize_hgvs(vid) for vid in vid_list]
         qbdr = ESQueryBuilder(**options.kwargs)
         try:
-            _q = qbdr.build_multiple_id_query(vid_list, scopes=options.scopes)
+            _q = qbdr.build_multiple_id_query(_vid_list, scopes=options.scopes)
         except MVQueryError as err:
             return {'success': False,
                     'error': err.message}
         if options.rawquery:
             return _q
-        res = self._es.msearch(body=_q, index=self._index, doc_type=self._doc_type)['responses']
+        res = self._timed_es_call(options, self._es.msearch, body=_q, index=self._index, doc_type=self._doc_type)['responses']
         if options.raw:
             return res
 
         assert len(res) == len(vid_list)
-        _res = []
+        with timed(options.timer, 'postprocess'):
+            return self._cleaned_msearch_res(res, vid_list, options)
 
+    def _cleaned_msearch_res(self, res, vid_list, options):
+        _res = []
         for i in range(len(res)):
             hits = res[i]
             qterm = vid_list[i]
-            hits = self._cleaned_res(hits, empty=[], single_hit=False)
+            hits = self._cleaned_res(hits, options, empty=[], single_hit=False)
             if len(hits) == 0:
                 _res.append({u'query': qterm,
                              u'notfound': True})
@@ -272,6 +626,60 @@ class ESQuery():
                     _res.append(hit)
         return _res
 
+    def _mget_variants_by_id(self, vid_list, options):
+        '''a fast path of mget_variants2 when scopes is "_id". A real-time mget
+           sends each id straight to its shard, instead of running a search
+           for each id on every shard. Returns the same structure as
+           mget_variants2. Ids are canonicalized (see canonicalize_hgvs),
+           "query" of each result is still the id as passed.
+        '''
+        _ids = [canonicalize_hgvs(vid) for vid in vid_list if vid]    # empty id is rejected by ES
+        if not (options.raw or options.rawquery):
+            self._check_build_version()
+            _ids = [vid for vid in _ids if not self._is_missing(vid)]
+        kwargs = {"_source": options.kwargs["_source"]} if "_source" in options.kwargs else {}
+        _routings = [get_routing(vid) for vid in _ids]
+        if any(_routings):
+            # with custom routing, each doc is fetched from the shard of its chromosome
+            _q = {'docs': [dict({'_id': vid}, **({'_routing': routing} if routing else {}))
+                           for vid, routing in zip(_ids, _routings)]}
+        else:
+            _q = {'ids': _ids}
+        if options.rawquery:
+            return _q
+        if _ids:
+            es = self._raw_es if options.raw and options.passthrough else self._es
+            res = self._timed_es_call(options, es.mget, body=_q, index=self._index, doc_type=self._doc_type, **kwargs)
+        else:
+            res = {'docs': []}
+        if options.raw:
+            return res
+
+        with timed(options.timer, 'postprocess'):
+            return self._cleaned_mget_res(res, vid_list, options, fetched=set(_ids))
+
+    def _cleaned_mget_res(self, res, vid_list, options, fetched=None):
+        '''fetched is the set of (canonical) ids sent to ES, all non-empty ids by default.'''
+        docs = iter(res['docs'])
+        _res = []
+        for qterm in vid_list:
+            doc = next(docs) if qterm and (fetched is None or canonicalize_hgvs(qterm) in fetched) else {}
+            if doc.get('found'):
+                doc.pop('_version', None)
+                hit = self._get_variantdoc(doc, options)
+                # keep the same fields as a hit from search, an id match
+                # is a constant score query.
+                hit[u'_score'] = 1.0
+                hit[u'query'] = qterm
+                _res.append(hit)
+            elif 'error' in doc:
+                _res.append({u'query': qterm,
+                             u'error': True})
+            else:
+                _res.append({u'query': qterm,
+                             u'notfound': True})
+        return _res
+
     def query(self, q, **kwargs):
         # Check if special interval query pattern exists
         interval_query = self._parse_interval_query(q)
@@ -279,40 +687,135 @@ class ESQuery():
         options = self._get_cleaned_query_options(kwargs)
         scroll_options = {}
         if options.fetch_all:
-            scroll_options.update({'search_type': 'scan', 'size': self._scroll_size, 'scroll': self._scroll_time})
+            num_shards = self.number_of_shards
+            routed = interval_query and get_chrom_routing(interval_query["chr"])
+            if routed:
+                num_shards = 1
+            if options.slices:
+                try:
+                    preference = self._get_slice_preference(options.slice, options.slices)
+                except MVQueryError as err:
+                    return {'success': False, 'error': str(err)}
+                if routed:
+                    # all the hits are in one shard, which may not be in the
+                    # shards of the slice: slice 0 has them all, the others none.
+                    if options.slice > 0:
+                        return self._empty_res(options)
+                else:
+                    scroll_options['preference'] = preference
+                    num_shards = len(preference.split(','))
+            if options.first_page:
+                # sorted by _doc, the efficient order to scroll through, as the
+                # deprecated scan search type, but the first response has the
+                # first page of hits, and size is the page size over all shards.
+                scroll_options.update({'sort': '_doc', 'size': self._fetch_all_page_size, 'scroll': self._scroll_time})
+            else:
+                # the first response only has the total and the _scroll_id,
+                # size is per shard.
+                size = int(math.ceil(float(self._fetch_all_page_size) / num_shards))
+                scroll_options.update({'search_type': 'scan', 'size': size, 'scroll': self._scroll_time})
         options['kwargs'].update(scroll_options)
+        try:
+            after_values = self._set_cursor(options)
+        except MVQueryError as err:
+            return {'success': False, 'error': str(err)}
         qbdr = ESQueryBuilder(**options.kwargs)
         if interval_query:
+            routing = get_chrom_routing(interval_query["chr"])
+            if routing:
+                # all variants of the chromosome are in one shard
+                options['kwargs']['routing'] = routing
+            self._check_build_version()
             _query = qbdr.build_interval_query(chr=interval_query["chr"],
                                                gstart=interval_query["gstart"],
                                                gend=interval_query["gend"],
                                                rquery=interval_query["query"],
-                                               hg38=self._hg38, **options['kwargs'])
+                                               hg38=options.hg38,
+                                               position_fields=self._has_position_fields,
+                                               **options['kwargs'])
         else:
             _query = qbdr.build_default_query(q=q, facets=facets)
+        if after_values:
+            _query = qbdr.add_search_after(_query, options.kwargs['sort'], after_values)
 
         if options.rawquery:
             return _query
 
         try:
-            res = self._es.search(index=self._index, doc_type=self._doc_type, body=_query, **options.kwargs)
+            es = self._raw_es if options.raw and options.passthrough and not options.fetch_all else self._es
+            res = self._timed_es_call(options, es.search, index=self._index, doc_type=self._doc_type,
+                                      body=_query, **options.kwargs)
         except RequestError:
             return {"error": "invalid query term.", "success": False}
 
+        if options.kwargs.get('size') == 0 and not (options.raw or options.fetch_all):
+            # count only, no hits to clean up
+            _res = {'total': res['hits']['total']}
+            for attr in ['took', 'facets', 'aggregations']:
+                if attr in res:
+                    _res[attr] = res[attr]
+            return _res
         if not options.raw:
-            res = self._clean_res2(res)
+            with timed(options.timer, 'postprocess'):
+                try:
+                    next_token = self._get_next_cursor(res, options)
+                except MVQueryError as err:
+                    return {'success': False, 'error': str(err)}
+                res = self._clean_res2(res, options)
+                if next_token:
+                    res['next'] = next_token
         return res
 
+    def _set_cursor(self, options):
+        '''if a cursor is requested (options.after is FIRST_PAGE_CURSOR or a
+           "next" token), add "_uid" as the last sort field, so that the order
+           is total and a page can be resumed after its last hit (see
+           self._get_next_cursor). _uid is only sorted on then, as it loads
+           the _uid fielddata. Return the sort values of the hit to resume
+           after, if any.
+
+           Relevance-sorted queries (no sort option) have no cursor.
+        '''
+        sort = options.kwargs.get('sort')
+        if options.fetch_all or not options.after:
+            return None
+        if not sort:
+            raise MVQueryError('"after" requires the "sort" parameter.')
+        if sort.split(',')[-1].split(':')[0] != '_uid':
+            sort += ',_uid:asc'
+            options['kwargs']['sort'] = sort
+        if options.after != FIRST_PAGE_CURSOR:
+            after_sort, values = decode_cursor(options.after)
+            if after_sort != sort or len(values) != len(sort.split(',')):
+                raise MVQueryError('"after" does not match the "sort" parameter of the query.')
+            # the page starts after the given hit, not at an offset
+            options['kwargs'].pop('from_', None)
+            return values
+
+    def _get_next_cursor(self, res, options):
+        '''return the token to get the next page of a sorted query, or None
+           if it's the last page or no cursor was requested (see self._set_cursor).'''
+        if options.fetch_all or not options.after:
+            return None
+        hits = res['hits']['hits']
+        if hits and 'sort' in hits[-1] and len(hits) >= int(options.kwargs.get('size', 10)):
+            values = hits[-1]['sort']
+            fields = [key.split(':')[0] for key in options.kwargs['sort'].split(',')]
+            if any(is_str(value) for field, value in zip(fields, values) if field != '_uid'):
+                # a range on terms does not match the min/max term ES sorts multi-valued fields by
+                raise MVQueryError('"after" is only supported when sorting on numeric fields.')
+            return encode_cursor(options.kwargs['sort'], values)
+
     def scroll(self, scroll_id, **kwargs):
-        '''return the results from a scroll ID, recognizes options.raw'''
+        '''return the results from a scroll ID, recognizes options.raw.'''
         options = self._get_cleaned_query_options(kwargs)
-        r = self._es.scroll(scroll_id, scroll=self._scroll_time)
+        r = self._timed_es_call(options, self._es.scroll, scroll_id, scroll=self._scroll_time)
         scroll_id = r.get('_scroll_id')
         if scroll_id is None or not r['hits']['hits']:
             return {'success': False, 'error': 'No results to return.'}
         else:
-            if not options.raw:
-                res = self._clean_res2(r)
+            with timed(options.timer, 'postprocess'):
+                res = r if options.raw else self._clean_res2(r, options)
             # res.update({'_scroll_id': scroll_id})
             if r['_shards']['failed']:
                 res.update({'_warning': 'Scroll request has failed on {} shards out of {}.'.format(r['_shards']['failed'], r['_shards']['total'])})
@@ -345,16 +848,211 @@ class ESQuery():
                         r['query'] = None
                     return r
 
+    def get_field_table(self):
+        '''return the FieldTable of the index, only rebuilt (from the mapping
+           and the field notes) when the index build version changes.'''
+        self._check_build_version()
+        field_table = self._field_table
+        if field_table is None:
+            with open(config.FIELD_NOTES_PATH, 'r') as in_f:
+                notes = json.load(in_f)
+            # the canonical position and hg38 id fields are only used internally for queries
+            properties = dict((k, v) for k, v in self.query_fields().items()
+                              if k not in INTERNAL_FIELDS and k != HG38_ID_FIELD)
+            field_table = FieldTable(properties, notes)
+            if self._build_version is not None:
+                self._field_table = field_table
+        return field_table
+
     def query_fields(self, **kwargs):
         # query the metadata to get the available fields for a variant object
         r = self._es.indices.get(index=self._index)
         return r[list(r.keys())[0]]['mappings']['variant']['properties']
 
+    def ping(self, **kwargs):
+        '''return True if the ES host responds, a cheap request to "/".'''
+        return self._es.ping(**kwargs)
+
     def get_mapping_meta(self):
         """return the current _meta field."""
         m = self._es.indices.get_mapping(index=self._index, doc_type=self._doc_type)
         m = m[self._index]['mappings'][self._doc_type]
-        return m.get('_meta', {})
+        meta = m.get('_meta', {})
+        # indices built before the canonical position fields were added
+        # are still queried over all source fields.
+        self._has_position_fields = 'hg19' in m.get('properties', {})
+        self._has_hg38_ids = HG38_ID_FIELD in m.get('properties', {})
+        self._set_build_version(meta)
+        return meta
+
+
+_shared_esq = None
+_shared_esq_lock = threading.Lock()
+
+
+def get_shared_esquery():
+    '''return the ESQuery instance shared by all web handlers. It's created on
+       first use, so importing the handlers does not need a reachable ES host,
+       and all handlers share one ES client and one set of caches.
+    '''
+    global _shared_esq
+    if _shared_esq is None:
+        with _shared_esq_lock:
+            if _shared_esq is None:
+                # size the ES connection pool to match the thread pool, otherwise
+                # the extra in-flight requests just wait for a free connection.
+                _shared_esq = ESQuery(maxsize=ES_ASYNC_WORKERS)
+    return _shared_esq
+
+
+class AsyncESQuery():
+    '''A non-blocking wrapper of ESQuery for tornado handlers.
+       Each method runs the corresponding (blocking) ESQuery method on a
+       shared thread pool and returns a Future, so it can be yielded from
+       a coroutine without stalling the IOLoop:
+
+            res = yield esq.get_variant(vid)
+
+       If esq is not provided, the shared ESQuery (see get_shared_esquery)
+       is used, so it's cheap to create one of these at import time.
+    '''
+    executor = ThreadPoolExecutor(max_workers=ES_ASYNC_WORKERS)
+
+    def __init__(self, esq=None):
+        self._esq_instance = esq
+        self._inflight = {}     # request key --> Future of the ES call in flight
+        self._coalescing_stats = {}     # method name --> [number of requests, number of coalesced]
+
+    @property
+    def _esq(self):
+        return self._esq_instance or get_shared_esquery()
+
+    def get_cache_stats(self):
+        return self._esq.get_cache_stats()
+
+    def get_build_meta(self):
+        if self._esq._build_meta_is_fresh():
+            # no ES request needed, skip the thread pool
+            future = Future()
+            future.set_result(self._esq._build_meta)
+            return future
+        return self._get_build_meta()
+
+    @run_on_executor
+    def _get_build_meta(self):
+        return self._esq.get_build_meta()
+
+    @run_on_executor
+    def exists(self, vid):
+        return self._esq.exists(vid)
+
+    def _coalesce(self, method, *args, **kwargs):
+        '''call method (run_on_executor-decorated) unless an identical call is
+           already in flight, in that case its Future (and the decoded result)
+           is shared. Must be called from the IOLoop thread.
+        '''
+        name = method.__name__.lstrip('_')
+        key = (name, args,
+               json.dumps(dict((k, v) for k, v in kwargs.items() if k not in ('host', 'timer')),
+                          sort_keys=True, default=str))
+        stats = self._coalescing_stats.setdefault(name, [0, 0])
+        stats[0] += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            stats[1] += 1
+            return future
+
+        def _done(f):
+            if self._inflight.get(key) is f:
+                del self._inflight[key]
+
+        future = method(*args, **kwargs)
+        self._inflight[key] = future
+        IOLoop.current().add_future(future, _done)
+        return future
+
+    def get_coalescing_stats(self):
+        '''return number of requests and how many of them were coalesced
+           into an identical in-flight request, per method.'''
+        stats = {}
+        for name, (total, coalesced) in self._coalescing_stats.items():
+            stats[name] = {'requests': total,
+                           'coalesced': coalesced,
+                           'ratio': float(coalesced) / total if total else 0.0}
+        return stats
+
+    def get_variant(self, vid, **kwargs):
+        vid = canonicalize_hgvs(vid)
+        esq = self._esq
+        if (not kwargs.get('raw') and not esq._use_hg38(kwargs.get('assembly')) and
+                esq._build_meta_is_fresh() and esq._is_missing(vid)):
+            # a definite miss, skip the thread pool
+            future = Future()
+            future.set_result(None)
+            return future
+        return self._coalesce(self._get_variant, vid, **kwargs)
+
+    @run_on_executor
+    def _get_variant(self, vid, **kwargs):
+        return self._esq.get_variant(vid, **kwargs)
+
+    @run_on_executor
+    def mget_variants2(self, vid_list, **kwargs):
+        return self._esq.mget_variants2(vid_list, **kwargs)
+
+    @run_on_executor
+    def mexists(self, vid_list, **kwargs):
+        return self._esq.mexists(vid_list, **kwargs)
+
+    def query(self, q, **kwargs):
+        if kwargs.get('fetch_all'):
+            # each fetch_all request needs its own scroll cursor
+            return self._query(q, **kwargs)
+        return self._coalesce(self._query, q, **kwargs)
+
+    @run_on_executor
+    def _query(self, q, **kwargs):
+        return self._esq.query(q, **kwargs)
+
+    @run_on_executor
+    def scroll(self, scroll_id, **kwargs):
+        return self._esq.scroll(scroll_id, **kwargs)
+
+    @run_on_executor
+    def query_fields(self, **kwargs):
+        return self._esq.query_fields(**kwargs)
+
+    def get_field_table(self):
+        if self._esq._build_meta_is_fresh() and self._esq._field_table is not None:
+            # served from memory, skip the thread pool
+            future = Future()
+            future.set_result(self._esq._field_table)
+            return future
+        return self._get_field_table()
+
+    @run_on_executor
+    def _get_field_table(self):
+        return self._esq.get_field_table()
+
+    @run_on_executor
+    def ping(self, **kwargs):
+        return self._esq.ping(**kwargs)
+
+    @run_on_executor
+    def get_mapping_meta(self):
+        return self._esq.get_mapping_meta()
+
+
+_shared_async_esq = None
+
+
+def get_async_esquery():
+    '''return the AsyncESQuery shared by all handlers, so that identical
+       requests to any handler can be coalesced.'''
+    global _shared_async_esq
+    if _shared_async_esq is None:
+        _shared_async_esq = AsyncESQuery()
+    return _shared_async_esq
 
 
 class ESQueryBuilder:
@@ -406,6 +1104,18 @@ class ESQueryBuilder:
         _q.update(self._query_options)
         return _q
 
+    def build_hg38_id_query(self, vid):
+        """make a query body matching the variant of an hg38 id, see HG38_ID_FIELD."""
+        return {
+            "query": {
+                "constant_score": {
+                    "filter": {
+                        "term": {HG38_ID_FIELD: vid}
+                    }
+                }
+            }
+        }
+
     def build_multiple_id_query(self, vid_list, scopes=None):
         """make a query body for msearch query."""
         _q = []
@@ -414,6 +1124,59 @@ class ESQueryBuilder:
         _q.append('')
         return '\n'.join(_q)
 
+    def _get_sort_value_filter(self, field, order, op, value):
+        """ Return a filter on the value a hit is sorted by: the min value
+            of a (numeric) field for the ascending order, the max for the
+            descending one, as ES sorts multi-valued fields.
+        """
+        mode = 'min' if order == 'asc' else 'max'
+        return {
+            "bool": {
+                "must": [
+                    {"exists": {"field": field}},
+                    {"script": {
+                        "script": {
+                            "inline": "doc['{}'].{}() {} value".format(field, mode, op),
+                            "lang": "expression",
+                            "params": {"value": value}
+                        }
+                    }}
+                ]
+            }
+        }
+
+    def add_search_after(self, query, sort, values):
+        """ Return query restricted to the hits sorted after a hit with the
+            given sort values (ES 2.x has no "search_after"). sort is the
+            sort option, e.g. "dbnsfp.aa.pos:asc,_uid:asc", on numeric fields
+            and _uid. Hits missing a sort field are sorted last, in both orders.
+        """
+        keys = [(key.rsplit(':', 1) + ['asc'])[:2] for key in sort.split(',')]
+        after = []
+        same = []    # conditions for the same values as the given hit, up to the current field
+        for (field, order), value in zip(keys, values):
+            is_missing = {"bool": {"must_not": {"exists": {"field": field}}}}
+            if value in MISSING_SORT_VALUES:
+                same.append(is_missing)
+                continue
+            if field == '_uid':    # never missing, single-valued
+                gt = {"range": {field: {"gt" if order == 'asc' else "lt": value}}}
+                eq = {"term": {field: value}}
+            else:
+                gt = {"bool": {"should": [self._get_sort_value_filter(field, order, '>' if order == 'asc' else '<', value),
+                                          is_missing]}}
+                eq = self._get_sort_value_filter(field, order, '==', value)
+            after.append({"bool": {"must": same + [gt]}})
+            same = same + [eq]
+        _query = dict(query)
+        _query["query"] = {
+            "bool": {
+                "must": query["query"],
+                "filter": {"bool": {"should": after}}
+            }
+        }
+        return _query
+
     def build_default_query(self, q, facets=None):
         """ Default query for request to /query endpoint - called by the ESQuery.query method. """
         _query = {
@@ -427,11 +1190,32 @@ class ESQueryBuilder:
             _query['facets'] = facets
         return _query
 
-    def build_interval_query(self, chr, gstart, gend, rquery, hg38, **kwargs):
-        """ Build an interval query - called by the ESQuery.query method. """
+    def build_interval_query(self, chr, gstart, gend, rquery, hg38, position_fields=False, **kwargs):
+        """ Build an interval query - called by the ESQuery.query method.
+            if position_fields is True, query the canonical "chrom" and
+            "hg19"/"hg38" fields (see dataindex/mapping.py), instead of the
+            fields of every source.
+        """
         if chr.lower().startswith('chr'):
             chr = chr[3:]
 
+        if position_fields:
+            assembly = 'hg38' if hg38 else 'hg19'
+            _query = {
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"term": {"chrom": chr.lower()}},
+                            {"range": {assembly + ".start": {"lte": gend}}},
+                            {"range": {assembly + ".end": {"gte": gstart}}}
+                        ]
+                    }
+                }
+            }
+            if rquery:
+                _query["query"]["bool"]["must"] = {"query_string": {"query": rquery}}
+            return _query
+
         # ES 1.x query
         #_query = {
         #    "query": {
@@ -0,0 +1,92 @@
+'''
+The field table served by /metadata/fields, built once per index version
+from the index mapping and the field notes.
+'''
+import bisect
+
+
+def flatten_mapping(properties, prefix=''):
+    '''return a flat dictionary of field path --> field info from the
+       "properties" of an ES mapping.'''
+    r = {}
+    for (k, v) in properties.items():
+        key = prefix + '.' + k if prefix else k
+        r[key] = {}
+        r[key]['indexed'] = False
+        if 'properties' not in v:
+            r[key]['type'] = v['type']
+            if ('index' not in v) or ('index' in v and v['index'] != 'no'):
+                # indexed field
+                r[key]['indexed'] = True
+        else:
+            r[key]['type'] = 'object'
+            r.update(flatten_mapping(v['properties'], key))
+        if ('include_in_all' in v) and v['include_in_all']:
+            r[key]['include_in_all'] = True
+        else:
+            r[key]['include_in_all'] = False
+    return r
+
+
+class FieldTable():
+    '''Flattened fields of the index, searchable by prefix and by substring.
+
+       Field names are kept sorted, so a prefix search is a binary search for
+       the range of names starting with it. For substring search, an n-gram
+       index maps each n-gram to the fields containing it, and only the
+       fields having all the n-grams of the search string are checked.
+
+       Returned field info dictionaries are shared, don't modify them.
+    '''
+    ngram_size = 3
+
+    def __init__(self, properties, notes=None):
+        notes = notes or {}
+        self.fields = flatten_mapping(properties)
+        for k, v in self.fields.items():
+            if k in notes:
+                v['notes'] = notes[k]
+        self._names = sorted(self.fields)
+        self._ngrams = {}    # n-gram --> set of positions in self._names
+        for i, name in enumerate(self._names):
+            for ngram in self._iter_ngrams(name):
+                self._ngrams.setdefault(ngram, set()).add(i)
+
+    def __len__(self):
+        return len(self._names)
+
+    def _iter_ngrams(self, s):
+        n = self.ngram_size
+        return set(s[i:i + n] for i in range(len(s) - n + 1))
+
+    def prefix_search(self, prefix):
+        '''return the names of the fields starting with prefix.'''
+        start = bisect.bisect_left(self._names, prefix)
+        end = start
+        while end < len(self._names) and self._names[end].startswith(prefix):
+            end += 1
+        return self._names[start:end]
+
+    def substring_search(self, search):
+        '''return the names of the fields containing search.'''
+        if len(search) < self.ngram_size:
+            return [name for name in self._names if search in name]
+        candidates = None
+        for ngram in self._iter_ngrams(search):
+            positions = self._ngrams.get(ngram)
+            if not positions:
+                return []
+            candidates = positions if candidates is None else candidates & positions
+        return [self._names[i] for i in sorted(candidates) if search in self._names[i]]
+
+    def search(self, search=None, prefix=None):
+        '''return a dictionary of field name --> info of the fields containing
+           search or starting with prefix, or of all fields if neither is given.'''
+        if not search and not prefix:
+            return dict(self.fields)
+        names = set()
+        if search:
+            names.update(self.substring_search(search))
+        if prefix:
+            names.update(self.prefix_search(prefix))
+        return dict((name, self.fields[name]) for name in names)
@@ -1,16 +1,26 @@
 import re
 import json
 
+from tornado import gen
 from tornado.web import HTTPError
 from www.helper import BaseHandler
-from .es import ESQuery
-from utils.common import split_ids
+from .es import get_async_esquery, get_build_version, get_build_timestamp
+from utils.common import split_ids, iter_n, is_str
 import config
 
 
+def mget_variants_in_batches(esq, ids, batch_size, **kwargs):
+    '''split ids into batches and query them concurrently,
+       return a list of futures, one per batch.'''
+    return [esq.mget_variants2(list(batch), **kwargs) for batch in iter_n(ids, batch_size)]
+
+
 class VariantHandler(BaseHandler):
-    esq = ESQuery()
+    esq = get_async_esquery()
+    metrics_endpoints = {'GET': 'variant_get', 'POST': 'variant_post'}
+    ndjson_batch_size = getattr(config, 'NDJSON_BATCH_SIZE', 100)
 
+    @gen.coroutine
     def get(self, vid=None):
         '''
         /variant/<variantid>
@@ -25,20 +35,15 @@ class VariantHandler(BaseHandler):
             email
         '''
         if vid:
-            # Get rid of HGVS ID errors
-            m = re.search('chr.{1,2}(?P<delim>:[g\.]{0,2})\d+', self.request.uri)
-            if m:
-                de = m.group('delim')
-                if de and de != ':g.':
-                    self.redirect(':g.'.join(self.request.uri.split(de)), permanent=True)
-            # Test for HGVS formatting errors
             kwargs = self.get_query_params()
-            self.esq._use_hg19()
-            if kwargs.pop('assembly', 'hg19').lower() == 'hg38':
-                self.esq._use_hg38()
-            variant = self.esq.get_variant(vid, **kwargs)
+            meta = yield self.esq.get_build_meta()
+            if self.check_not_modified(get_build_version(meta), get_build_timestamp(meta)):
+                return
+            # HGVS formatting errors are fixed by canonicalize_hgvs, in esq.get_variant
+            kwargs['passthrough'] = self.can_passthrough()
+            variant = yield self.esq.get_variant(vid, **kwargs)
             if variant:
-                self.return_json(variant)
+                self.return_json(variant, encode=not is_str(variant))
                 self.ga_track(event={'category': 'v1_api',
                                      'action': 'variant_get'})
             else:
@@ -46,6 +51,7 @@ class VariantHandler(BaseHandler):
         else:
             raise HTTPError(404)
 
+    @gen.coroutine
     def post(self, ids=None):
         '''
            This is essentially the same as post request in QueryHandler, with different defaults.
@@ -54,19 +60,31 @@ class VariantHandler(BaseHandler):
             ids
             fields
             email
+            out_format  if "ndjson", stream one JSON doc per line as each batch is ready.
+            ordered     if false, ndjson batches are written as soon as they return.
+            exists      if true, return only true/false for each id, if it's found.
         '''
         kwargs = self.get_query_params()
-        self.esq._use_hg19()
-        if kwargs.pop('assembly', 'hg19').lower() == 'hg38':
-            self.esq._use_hg38()
         ids = kwargs.pop('ids', None)
+        out_format = kwargs.pop('out_format', 'json')
+        ordered = kwargs.pop('ordered', True)
+        exists = kwargs.pop('exists', False)
         if ids:
             ids = re.split('[\s\r\n+|,]+', ids)
-            res = self.esq.mget_variants2(ids, **kwargs)
+            if exists:
+                res = yield self.esq.mexists(ids, **kwargs)
+            elif out_format == 'ndjson':
+                res = None
+                futures = mget_variants_in_batches(self.esq, ids, self.ndjson_batch_size, **kwargs)
+            else:
+                res = yield self.esq.mget_variants2(ids, passthrough=self.can_passthrough(), **kwargs)
         else:
             res = {'success': False, 'error': "Missing required parameters."}
-        encode = not isinstance(res, str)    # when res is a string, e.g. when rawquery is true, do not encode it as json
-        self.return_json(res, encode=encode)
+        if res is None:
+            yield self.return_ndjson_stream(futures, ordered=ordered)
+        else:
+            encode = not isinstance(res, str)    # when res is a string, e.g. when rawquery is true, do not encode it as json
+            self.return_json(res, encode=encode)
         self.ga_track(event={'category': 'v1_api',
                              'action': 'variant_post',
                              'label': 'qsize',
@@ -74,35 +92,52 @@ class VariantHandler(BaseHandler):
 
 
 class QueryHandler(BaseHandler):
-    esq = ESQuery()
+    esq = get_async_esquery()
+    metrics_endpoints = {'GET': 'query_get', 'POST': 'query_post'}
+    ndjson_batch_size = getattr(config, 'NDJSON_BATCH_SIZE', 100)
 
+    @gen.coroutine
     def get(self):
         '''
         parameters:
             q
             fields
             from
-            size
+            size        if 0, only the total (and facets) is returned, no hits.
             sort
             facets
             callback
             email
-            fetch_all
+            fetch_all   the response has a "_scroll_id" to get the pages of hits.
+            first_page  with fetch_all, the response also has the first page of hits.
+            slices      with fetch_all, split the results into this number of
+                        slices, each one scrolled through with its own scroll_id.
+                        For an interval query on an index routed by chromosome,
+                        slice 0 has all the hits.
+            slice       with slices, the slice to get, from 0 to slices - 1.
+            after       the "next" token of the previous page of a sorted query, to get
+                        the page after it. Unlike "from", it's cheap for deep pages.
+                        Pass "start" to get the first page with its "next" token.
+                        Only for sorting on numeric fields.
 
             explain
             raw
         '''
         kwargs = self.get_query_params()
-        self.esq._use_hg19()
-        if kwargs.pop('assembly', 'hg19').lower() == 'hg38':
-            self.esq._use_hg38()
         q = kwargs.pop('q', None)
         scroll_id = kwargs.pop('scroll_id', None)
         _has_error = False
+        _stream = False
         if scroll_id:
-            res = self.esq.scroll(scroll_id, **kwargs)
+            # scroll pages can be large, stream them out in chunks
+            res = yield self.esq.scroll(scroll_id, **kwargs)
+            _stream = True
         elif q:
-            for arg in ['from', 'size']:
+            if not kwargs.get('fetch_all', False):
+                meta = yield self.esq.get_build_meta()
+                if self.check_not_modified(get_build_version(meta), get_build_timestamp(meta)):
+                    return
+            for arg in ['from', 'size', 'slice', 'slices']:
                 value = kwargs.get(arg, None)
                 if value:
                     try:
@@ -111,8 +146,12 @@ class QueryHandler(BaseHandler):
                         res = {'success': False, 'error': 'Parameter "{}" must be an integer.'.format(arg)}
                         _has_error = True
             if not _has_error:
-                res = self.esq.query(q, **kwargs)
-                if kwargs.get('fetch_all', False):
+                fetch_all = kwargs.get('fetch_all', False)
+                # with first_page, the first page of a fetch_all has up to
+                # FETCH_ALL_PAGE_SIZE hits, streamed like scroll pages
+                res = yield self.esq.query(q, passthrough=self.can_passthrough(), **kwargs)
+                _stream = fetch_all
+                if fetch_all:
                     self.ga_track(event={'category': 'v1_api',
                                          'action': 'fetch_all',
                                          'label': 'total',
@@ -121,12 +160,16 @@ class QueryHandler(BaseHandler):
         else:
             res = {'success': False, 'error': "Missing required parameters."}
 
-        self.return_json(res)
+        if _stream:
+            yield self.return_json_stream(res)
+        else:
+            self.return_json(res, encode=not is_str(res))
         self.ga_track(event={'category': 'v1_api',
                              'action': 'query_get',
                              'label': 'qsize',
                              'value': len(q) if q else 0})
 
+    @gen.coroutine
     def post(self):
         '''
         parameters:
@@ -136,13 +179,16 @@ class QueryHandler(BaseHandler):
             email
 
             jsoninput   if true, input "q" is a json string, must be decoded as a list.
+            out_format  if "ndjson", stream one JSON doc per line as each batch is ready.
+            ordered     if false, ndjson batches are written as soon as they return.
+            exists      if true, return only true/false for each input, if any variant matches it.
         '''
         kwargs = self.get_query_params()
-        self.esq._use_hg19()
-        if kwargs.pop('assembly', 'hg19').lower() == 'hg38':
-            self.esq._use_hg38()
         q = kwargs.pop('q', None)
         jsoninput = kwargs.pop('jsoninput', None) in ('1', 'true')
+        out_format = kwargs.pop('out_format', 'json')
+        ordered = kwargs.pop('ordered', True)
+        exists = kwargs.pop('exists', False)
         if q:
             # ids = re.split('[\s\r\n+|,]+', q)
             try:
@@ -155,12 +201,23 @@ class QueryHandler(BaseHandler):
             if ids:
                 scopes = kwargs.pop('scopes', None)
                 fields = kwargs.pop('fields', None)
-                res = self.esq.mget_variants2(ids, fields=fields, scopes=scopes, **kwargs)
+                if exists:
+                    res = yield self.esq.mexists(ids, scopes=scopes, **kwargs)
+                elif out_format == 'ndjson':
+                    res = None
+                    futures = mget_variants_in_batches(self.esq, ids, self.ndjson_batch_size,
+                                                       fields=fields, scopes=scopes, **kwargs)
+                else:
+                    res = yield self.esq.mget_variants2(ids, fields=fields, scopes=scopes,
+                                                        passthrough=self.can_passthrough(), **kwargs)
         else:
             res = {'success': False, 'error': "Missing required parameters."}
 
-        encode = not isinstance(res, str)    # when res is a string, e.g. when rawquery is true, do not encode it as json
-        self.return_json(res, encode=encode)
+        if res is None:
+            yield self.return_ndjson_stream(futures, ordered=ordered)
+        else:
+            encode = not isinstance(res, str)    # when res is a string, e.g. when rawquery is true, do not encode it as json
+            self.return_json(res, encode=encode)
         self.ga_track(event={'category': 'v1_api',
                              'action': 'query_post',
                              'label': 'qsize',
@@ -168,50 +225,26 @@ class QueryHandler(BaseHandler):
 
 
 class MetaDataHandler(BaseHandler):
-    esq = ESQuery()
+    esq = get_async_esquery()
     disable_caching = True
 
+    @gen.coroutine
     def get(self):
-        _meta = self.esq.get_mapping_meta()
+        _meta = yield self.esq.get_mapping_meta()
         self.return_json(_meta)
 
 
 class FieldsHandler(BaseHandler):
-    esq = ESQuery()
+    esq = get_async_esquery()
 
+    @gen.coroutine
     def get(self):
-        notes = json.load(open(config.FIELD_NOTES_PATH, 'r'))
-        es_mapping = self.esq.query_fields()
+        meta = yield self.esq.get_build_meta()
+        if self.check_not_modified(get_build_version(meta), get_build_timestamp(meta)):
+            return
+        field_table = yield self.esq.get_field_table()
         kwargs = self.get_query_params()
-
-        def get_indexed_properties_in_dict(d, prefix):
-            r = {}
-            for (k, v) in d.items():
-                r[prefix + '.' + k] = {}
-                r[prefix + '.' + k]['indexed'] = False
-                if 'properties' not in v:
-                    r[prefix + '.' + k]['type'] = v['type']
-                    if ('index' not in v) or ('index' in v and v['index'] != 'no'):
-                        # indexed field
-                        r[prefix + '.' + k]['indexed'] = True
-                else:
-                    r[prefix + '.' + k]['type'] = 'object'
-                    r.update(get_indexed_properties_in_dict(v['properties'], prefix + '.' + k))
-                if ('include_in_all' in v) and v['include_in_all']:
-                    r[prefix + '.' + k]['include_in_all'] = True
-                else:
-                    r[prefix + '.' + k]['include_in_all'] = False
-            return r
-
-        r = {}
-        search = kwargs.pop('search', None)
-        prefix = kwargs.pop('prefix', None)
-        for (k, v) in get_indexed_properties_in_dict(es_mapping, '').items():
-            k1 = k.lstrip('.')
-            if (search and search in k1) or (prefix and k1.startswith(prefix)) or (not search and not prefix):
-                r[k1] = v
-                if k1 in notes:
-                    r[k1]['notes'] = notes[k1]
+        r = field_table.search(search=kwargs.pop('search', None), prefix=kwargs.pop('prefix', None))
         self.return_json(r)
 
 
@@ -1,9 +1,11 @@
+from tornado import gen
 from www.helper import BaseHandler
-from www.api.es import ESQuery
+from www.api.es import get_async_esquery
 import json
 
 class BeaconHandler(BaseHandler):
-    esq = ESQuery()
+    esq = get_async_esquery()
+    metrics_endpoints = {'GET': 'beacon', 'POST': 'beacon'}
     """
     def post(self, src = None):
         data = json.loads(self.request.body.decode('utf-8'))
@@ -18,6 +20,7 @@ class BeaconHandler(BaseHandler):
         #Return the JSON response
         self.return_json(out)
     """
+    @gen.coroutine
     def post(self, src = None):
 
         chrom = self.get_argument('genome.chrom', None)
@@ -25,12 +28,13 @@ class BeaconHandler(BaseHandler):
         allele = self.get_argument('genome.allele', None)
         assembly = self.get_argument('genome.assembly', default='GRCh37')
 
-        out = self.get_output(chrom, pos, allele, assembly, src)
+        out = yield self.get_output(chrom, pos, allele, assembly, src)
 
         #Return the JSON response
         self.return_json(out)
 
 
+    @gen.coroutine
     def get(self, src=None):
        
         chrom = self.get_argument('chrom', None)
@@ -38,12 +42,13 @@ class BeaconHandler(BaseHandler):
         allele = self.get_argument('allele', None)
         assembly = self.get_argument('assembly', default='GRCh37')
 
-        out = self.get_output(chrom, pos, allele, assembly, src)
+        out = yield self.get_output(chrom, pos, allele, assembly, src)
 
         #Return the JSON response
         self.return_json(out)
 
 
+    @gen.coroutine
     def get_output(self, chrom, pos, allele, assembly, src):             
         #Initialize Sources and Output
         pos_dbs = ['wellderly', 'exac', 'cadd'] #cadd not working (no alt)
@@ -65,13 +70,13 @@ class BeaconHandler(BaseHandler):
             q = q.format(chrom, pos, allele)
 
             # perform query and format result
-            res = self.esq.query(q)
+            res = yield self.esq.query(q, timer=self.timer)
             if res and res.get('total') > 0:
                 if src in pos_dbs+hg19_dbs:
                     out = self.format_output_src(res, src, out)
                 else:
                     out = self.verify_hits(res.get('hits'), out, allele)
-        return(out)
+        raise gen.Return(out)
 
 
     def format_output_src(self, res, src, out):
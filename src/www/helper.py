@@ -1,33 +1,40 @@
-import json
+import hashlib
 import datetime
+import email.utils
 import tornado.web
 import traceback
+from tornado import gen
 from utils.ga import GAMixIn
-from collections import OrderedDict
-
-SUPPORT_MSGPACK = True
-if SUPPORT_MSGPACK:
-    import msgpack
-
-    def msgpack_encode_datetime(obj):
-        if isinstance(obj, datetime.datetime):
-            return {'__datetime__': True, 'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")}
-        return obj
-
-
-class DateTimeJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        else:
-            return super(DateTimeJSONEncoder, self).default(obj)
+from utils.serializer import SUPPORT_MSGPACK, to_json, to_msgpack
+from utils.metrics import StageTimer, timed, metrics
+from www import worker
 
 
 class BaseHandler(tornado.web.RequestHandler, GAMixIn):
     jsonp_parameter = 'callback'
     cache_max_age = 604800  # 7days
     disable_caching = False
-    boolean_parameters = set(['raw', 'rawquery', 'fetch_all', 'explain', 'jsonld'])
+    boolean_parameters = set(['raw', 'rawquery', 'fetch_all', 'first_page', 'explain', 'jsonld', 'ordered', 'exists'])
+    pretty_indent = 2    # indent used when "pretty" parameter is passed
+    stream_chunk_size = 100    # items encoded and flushed at a time by return_json_stream
+    metrics_endpoints = {}    # HTTP method --> endpoint name used in the latency metrics
+
+    def prepare(self):
+        worker.stats.request_started()
+        self._request_counted = True
+        self.timer = StageTimer()
+
+    def on_finish(self):
+        # requests rejected before prepare (e.g. 405) were not counted as started
+        if getattr(self, '_request_counted', False):
+            worker.stats.request_finished(self.get_status())
+            endpoint = self.metrics_endpoints.get(self.request.method)
+            if endpoint:
+                metrics.observe_request(endpoint, self.request.request_time(), self.timer)
+
+    def ga_track(self, event={}):
+        with timed(getattr(self, 'timer', None), 'ga'):
+            GAMixIn.ga_track(self, event=event)
 
     def write_error(self, status_code, **kwargs):
         """Override to implement custom error pages.
@@ -99,6 +106,9 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
                 _args[k] = v
         _args.pop(self.jsonp_parameter, None)   # exclude jsonp parameter if passed.
         _args['host'] = self.request.host
+        _args['timer'] = getattr(self, 'timer', None)
+        _args.pop('pretty', None)
+        _args.pop('passthrough', None)    # see can_passthrough
         if SUPPORT_MSGPACK:
             _args.pop('msgpack', None)
         self._check_fields_param(_args)
@@ -112,19 +122,24 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
     #         return None
     #     return tornado.escape.json_decode(user_json)
 
-    def _sort_response_object(self, d, depth=0):
-        '''sort this dictionary.  max_depth is how many levels deep we should sort
-           dictionary keys.  lists are included as a level.
-           depth is the current depth, pretty basic recursion
-        '''
-        max_depth = 6
-        depth += 1
-        if (depth <= max_depth) and isinstance(d, list):
-            return [self._sort_response_object(ds, depth) for ds in d]
-        elif (depth <= max_depth) and isinstance(d, dict):
-            return OrderedDict([(k, self._sort_response_object(d[k], depth)) for k in sorted(d)])
-        else:
-            return d
+    def _get_indent(self, indent=None):
+        '''return the indent to encode the response with: compact by default,
+           pretty-printed if "pretty" parameter is passed (e.g. pretty=1).'''
+        if indent:
+            return indent
+        pretty = self.get_argument('pretty', '').lower()
+        return self.pretty_indent if pretty in ['1', 'true'] else None
+
+    def _use_msgpack(self):
+        return SUPPORT_MSGPACK and bool(self.get_argument('msgpack', ''))
+
+    def can_passthrough(self):
+        '''return True if the response can be written as an ES response string
+           passed through undecoded (see ESQuery "passthrough" option), i.e.
+           it's asked for with the "passthrough" parameter (as its keys are not
+           sorted like in the other responses), and it's JSON and not re-formatted.'''
+        passthrough = self.get_argument('passthrough', '').lower() in ['1', 'true']
+        return passthrough and not self._use_msgpack() and not self._get_indent()
 
     def return_json(self, data, encode=True, indent=None):
         '''return passed data object as JSON response.
@@ -132,19 +147,14 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
            if encode is False, assumes input data is already a JSON encoded
            string.
         '''
-        # call the recursive function to sort the data by keys
-        data = self._sort_response_object(data, depth=0)
-
-        indent = indent or 2   # tmp settings
         jsoncallback = self.get_argument(self.jsonp_parameter, '')  # return as JSONP
-        if SUPPORT_MSGPACK:
-            use_msgpack = self.get_argument('msgpack', '')
-        if SUPPORT_MSGPACK and use_msgpack:
-            _json_data = msgpack.packb(data, use_bin_type=True, default=msgpack_encode_datetime)
-            self.set_header("Content-Type", "application/x-msgpack")
-        else:
-            _json_data = json.dumps(data, cls=DateTimeJSONEncoder, indent=indent) if encode else data
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        with timed(getattr(self, 'timer', None), 'encode'):
+            if self._use_msgpack():
+                _json_data = to_msgpack(data)
+                self.set_header("Content-Type", "application/x-msgpack")
+            else:
+                _json_data = to_json(data, indent=self._get_indent(indent)) if encode else data
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
         if not self.disable_caching:
             #get etag if data is a dictionary and has "etag" attribute.
             etag = data.get('etag', None) if isinstance(data, dict) else None
@@ -155,6 +165,78 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
         else:
             self.write(_json_data)
 
+    @gen.coroutine
+    def return_json_stream(self, data, stream_key='hits', indent=None):
+        '''return passed data object as JSON response like return_json, but
+           the items of the list data[stream_key] are encoded and flushed to
+           the client stream_chunk_size at a time, so the whole response is
+           never held in memory as one string, and the IOLoop is not blocked
+           while a large page is encoded. Must be yielded from a coroutine.
+
+           Falls back to return_json for msgpack output or if data[stream_key]
+           is not a list (e.g. a raw ES response, where "hits" is a dict).
+        '''
+        items = data.get(stream_key) if isinstance(data, dict) else None
+        if self._use_msgpack() or not isinstance(items, list):
+            self.return_json(data)
+            return
+
+        indent = self._get_indent(indent)
+        jsoncallback = self.get_argument(self.jsonp_parameter, '')  # return as JSONP
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        if not self.disable_caching:
+            self.set_cacheable()
+        self.support_cors()
+        if jsoncallback:
+            self.write('%s(' % jsoncallback)
+        self.write('{')
+        for i, key in enumerate(sorted(data)):
+            if i > 0:
+                self.write(',')
+            self.write(to_json(key) + ':')
+            if key == stream_key:
+                self.write('[')
+                for j in range(0, len(items), self.stream_chunk_size):
+                    with timed(self.timer, 'encode'):
+                        chunk = ','.join(to_json(item, indent=indent) for item in items[j:j + self.stream_chunk_size])
+                    self.write(chunk if j == 0 else ',' + chunk)
+                    # wait for the chunk to be sent before encoding the next one
+                    yield self.flush()
+                self.write(']')
+            else:
+                self.write(to_json(data[key], indent=indent))
+        self.write('}')
+        if jsoncallback:
+            self.write(')')
+
+    @gen.coroutine
+    def return_ndjson_stream(self, futures, ordered=True):
+        '''return newline-delimited JSON, one line per object, from a list of
+           futures, each resolving to a list of objects (or a single object).
+           Objects of each future are written and flushed as soon as it is
+           resolved. if ordered is False, futures are written in the order
+           they complete, not in the input order. Must be yielded from a coroutine.
+        '''
+        self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        self.support_cors()
+        if ordered:
+            for future in futures:
+                res = yield future
+                yield self._write_ndjson(res)
+        else:
+            wait_iterator = gen.WaitIterator(*futures)
+            while not wait_iterator.done():
+                res = yield wait_iterator.next()
+                yield self._write_ndjson(res)
+
+    def _write_ndjson(self, res):
+        if not isinstance(res, list):
+            res = [res]
+        with timed(self.timer, 'encode'):
+            for item in res:
+                self.write(to_json(item) + '\n')
+        return self.flush()
+
     def set_cacheable(self, etag=None):
         '''set proper header to make the response cacheable.
            set etag if provided.
@@ -163,6 +245,38 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
         if etag:
             self.set_header('Etag', etag)
 
+    def check_not_modified(self, build_version, last_modified=None):
+        '''Set an Etag derived from the index build version and the request
+           parameters, and a Last-Modified header if provided (a datetime).
+           Returns True, after sending a "304 Not Modified" response, if the
+           client's cached copy is still valid. This can be called before any
+           ES query is made:
+
+               if self.check_not_modified(version, timestamp):
+                   return
+        '''
+        if self.disable_caching or not build_version:
+            return False
+        _args = sorted((k, v) for k, values in self.request.query_arguments.items() for v in values)
+        _key = repr((build_version, self.request.path, _args)).encode('utf-8')
+        self.set_header('Etag', '"{}"'.format(hashlib.sha1(_key).hexdigest()))
+        if last_modified:
+            self.set_header('Last-Modified', last_modified)
+
+        if self.request.headers.get('If-None-Match'):
+            not_modified = self.check_etag_header()
+        else:
+            not_modified = False
+            ims_value = self.request.headers.get('If-Modified-Since')
+            if last_modified and ims_value:
+                date_tuple = email.utils.parsedate(ims_value)
+                if date_tuple is not None:
+                    not_modified = datetime.datetime(*date_tuple[:6]) >= last_modified.replace(microsecond=0)
+        if not_modified:
+            self.set_status(304)
+            self.finish()
+        return not_modified
+
     def support_cors(self, *args, **kwargs):
         '''Provide server side support for CORS request.'''
         self.set_header("Access-Control-Allow-Origin", "*")
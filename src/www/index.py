@@ -14,6 +14,7 @@ import os.path
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
 import tornado.web
 import tornado.escape
@@ -24,12 +25,16 @@ if src_path not in sys.path:
     sys.path.append(src_path)
 #from config import INCLUDE_DOCS
 
-from www.api.es import ESQuery
+from www.api.es import get_async_esquery
 from www.helper import add_apps
+from www import worker
+from utils.metrics import metrics, format_metric
+from utils.ga import ga_dispatcher
 from www.api.handlers import APP_LIST as api_app_list
 from www.api.handlers import MetaDataHandler
 from www.api.handlers import FieldsHandler
 from www.beacon.handlers import APP_LIST as beacon_app_list
+from www.status import APP_LIST as status_app_list
 
 __USE_WSGI__ = False
 #DOCS_STATIC_PATH = os.path.join(src_path, 'docs/_build/html')
@@ -40,7 +45,11 @@ STATIC_PATH = os.path.join(src_path, 'www/static')
 define("port", default=8000, help="run on the given port", type=int)
 define("address", default="127.0.0.1", help="run on localhost")
 define("debug", default=False, type=bool, help="run in debug mode")
+define("processes", default=1, type=int,
+       help="number of worker processes to fork, 0 for one per CPU")
 tornado.options.parse_command_line()
+if options.debug and options.processes != 1:
+    sys.exit('Debug mode (autoreload) cannot be used with multiple processes.')
 if options.debug:
     import tornado.autoreload
     import logging
@@ -48,15 +57,38 @@ if options.debug:
     options.address = '0.0.0.0'
 
 
-class StatusCheckHandler(tornado.web.RequestHandler):
-    ''' Handles requests to check the status of the server. '''
-    def head(self):
-        esq = ESQuery()
-        esq = esq.get_variant('chr1:g.218631822G>A')
-
+class MetricsHandler(tornado.web.RequestHandler):
+    ''' Returns latency histograms and cache counters of this worker process
+        in the Prometheus text format. '''
     def get(self):
-        self.head()
-        self.write('OK')
+        esq = get_async_esquery()
+        cache_stats = esq.get_cache_stats()
+        lines = [metrics.render().rstrip('\n')]
+        lines += format_metric('myvariant_variant_cache_hits_total', [((), cache_stats['hits'])],
+                               'counter', 'Hits of the get_variant cache.')
+        lines += format_metric('myvariant_variant_cache_misses_total', [((), cache_stats['misses'])],
+                               'counter', 'Misses of the get_variant cache.')
+        lines += format_metric('myvariant_variant_cache_size', [((), cache_stats['size'])],
+                               'gauge', 'Number of docs in the get_variant cache.')
+        lines += format_metric('myvariant_id_filter_skipped_total', [((), cache_stats['id_filter']['skipped'])],
+                               'counter', 'Ids answered as not found by the id filter, without an ES request.')
+        coalescing = sorted(esq.get_coalescing_stats().items())
+        lines += format_metric('myvariant_coalescing_requests_total',
+                               [((('method', k),), v['requests']) for k, v in coalescing],
+                               'counter', 'Calls to the ESQuery methods which can be coalesced.')
+        lines += format_metric('myvariant_coalescing_coalesced_total',
+                               [((('method', k),), v['coalesced']) for k, v in coalescing],
+                               'counter', 'ES requests served by an identical in-flight request.')
+        lines += format_metric('myvariant_worker_requests_total', [((), worker.stats.requests)],
+                               'counter', 'API requests served by this worker process.')
+        lines += format_metric('myvariant_ga_hits_total',
+                               [((('status', k),), v) for k, v in sorted(ga_dispatcher.stats.items())],
+                               'counter', 'GA hits by status (queued, dropped, aggregated, sent, errors).')
+        lines += format_metric('myvariant_ga_queue_size', [((), len(ga_dispatcher._queue))],
+                               'gauge', 'GA hits waiting to be sent.')
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write('\n'.join(line for line in lines if line) + '\n')
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -73,12 +105,13 @@ class DemoHandler(tornado.web.RequestHandler):
 
 APP_LIST = [
     (r"/", MainHandler),
-    (r"/status", StatusCheckHandler),
+    (r"/metrics", MetricsHandler),
     (r"/metadata", MetaDataHandler),
     (r"/metadata/fields", FieldsHandler),
     (r"/demo/?$", DemoHandler),
 ]
 
+APP_LIST += status_app_list
 APP_LIST += add_apps('api', api_app_list)
 APP_LIST += add_apps('v1', api_app_list)
 APP_LIST += add_apps('beacon', beacon_app_list)
@@ -96,8 +129,16 @@ if options.debug:
 
 def main():
     application = tornado.web.Application(APP_LIST, **settings)
-    http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(options.port, address=options.address)
+    if options.processes != 1:
+        # bind once, then fork the workers sharing the listening socket
+        sockets = tornado.netutil.bind_sockets(options.port, address=options.address)
+        worker.fork_workers(options.processes)
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+        worker.install_graceful_shutdown(http_server)
+    else:
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.listen(options.port, address=options.address)
     loop = tornado.ioloop.IOLoop.instance()
     if options.debug:
         tornado.autoreload.start(loop)
@@ -105,6 +146,7 @@ def main():
         logging.info('Server is running on "%s:%s"...' % (options.address, options.port))
 
     loop.start()
+    sys.exit(worker.stats.exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+'''
+Health checks of the web node.
+
+    /status          readiness, "OK" or 503 (HEAD or GET), for load balancers
+    /status/live     liveness, the process is up and its IOLoop responsive
+    /status/ready    readiness, with the latest ES check as JSON
+    /status/worker   stats of the worker process serving the request
+
+Readiness is answered from a cached verdict, refreshed by a background ES
+ping every HEALTH_CHECK_INTERVAL seconds, so probes add no load on ES.
+Pass deep=1 to /status or /status/ready to also fetch a variant document.
+'''
+import time
+import tornado.web
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+
+from www.api.es import get_async_esquery
+from www import worker
+import config
+
+
+class HealthMonitor():
+    '''pings ES in the background and keeps the latest verdict.'''
+    def __init__(self, esq, interval=10, timeout=2):
+        self.esq = esq
+        self.interval = interval    # in seconds
+        self.timeout = timeout      # ES ping timeout, in seconds
+        self.verdict = None
+        self._periodic_callback = None
+
+    def start(self):
+        '''start the background checks, on first use, so that they run on the
+           (worker's) current IOLoop.'''
+        if self._periodic_callback is None:
+            self._periodic_callback = PeriodicCallback(self.check, self.interval * 1000)
+            self._periodic_callback.start()
+
+    @gen.coroutine
+    def check(self):
+        '''ping ES, update and return the verdict.'''
+        t0 = time.time()
+        try:
+            ok = yield self.esq.ping(request_timeout=self.timeout)
+            error = None if ok else 'ES host is not reachable.'
+        except Exception as e:
+            ok, error = False, str(e)
+        verdict = {'ok': ok, 'checked': time.time(), 'latency': round(time.time() - t0, 4)}
+        if error:
+            verdict['error'] = error
+        self.verdict = verdict
+        raise gen.Return(verdict)
+
+    def get_verdict(self):
+        '''return the latest verdict, None if not checked yet or out of date
+           (e.g. the checks are stuck behind slow ES requests).'''
+        if self.verdict and time.time() - self.verdict['checked'] <= self.interval * 3:
+            return self.verdict
+
+health_monitor = HealthMonitor(get_async_esquery(),
+                               interval=getattr(config, 'HEALTH_CHECK_INTERVAL', 10),
+                               timeout=getattr(config, 'HEALTH_CHECK_TIMEOUT', 2))
+
+
+class LivenessHandler(tornado.web.RequestHandler):
+    ''' The process is up, does not depend on ES. '''
+    def head(self):
+        self.set_header('Cache-Control', 'no-cache')
+
+    def get(self):
+        self.head()
+        self.write('OK')
+
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    ''' Ready to serve requests, i.e. ES is reachable. '''
+    deep_check_id = getattr(config, 'STATUS_CHECK_ID', 'chr1:g.218631822G>A')
+
+    @gen.coroutine
+    def get_verdict(self):
+        health_monitor.start()
+        verdict = health_monitor.get_verdict()
+        if verdict is None:
+            verdict = yield health_monitor.check()
+        if self.get_argument('deep', '').lower() in ['1', 'true']:
+            verdict = dict(verdict)
+            try:
+                # raw requests skip the variant cache
+                doc = yield get_async_esquery().get_variant(self.deep_check_id, raw=True)
+                verdict['deep'] = bool(doc)
+            except Exception as e:
+                verdict['deep'] = False
+                verdict['error'] = str(e)
+            verdict['ok'] = verdict['ok'] and verdict['deep']
+        self.set_header('Cache-Control', 'no-cache')
+        if not verdict['ok']:
+            self.set_status(503)
+        raise gen.Return(verdict)
+
+    @gen.coroutine
+    def head(self):
+        yield self.get_verdict()
+
+    @gen.coroutine
+    def get(self):
+        verdict = yield self.get_verdict()
+        self.write(verdict)
+
+
+class StatusCheckHandler(ReadinessHandler):
+    ''' Handles requests to check the status of the server. '''
+    @gen.coroutine
+    def get(self):
+        verdict = yield self.get_verdict()
+        self.write('OK' if verdict['ok'] else 'ERROR')
+
+
+class WorkerStatusHandler(tornado.web.RequestHandler):
+    ''' Returns the stats of the worker process serving this request. '''
+    def get(self):
+        esq = get_async_esquery()
+        out = worker.stats.as_dict()
+        out['variant_cache'] = esq.get_cache_stats()
+        out['coalescing'] = esq.get_coalescing_stats()
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(out)
+
+
+APP_LIST = [
+    (r"/status", StatusCheckHandler),
+    (r"/status/live", LivenessHandler),
+    (r"/status/ready", ReadinessHandler),
+    (r"/status/worker", WorkerStatusHandler),
+]
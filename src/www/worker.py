@@ -0,0 +1,174 @@
+'''
+Pre-fork multi-process serving for the web node.
+
+The listening socket is bound once in the master process, then
+fork_workers forks the worker processes, each running its own IOLoop
+on the shared socket (the same model as tornado.process.fork_processes):
+
+    sockets = tornado.netutil.bind_sockets(port, address=address)
+    task_id = fork_workers(n)     # only returns in the workers
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
+    install_graceful_shutdown(http_server)
+    IOLoop.current().start()
+    sys.exit(stats.exit_code)
+
+Signals sent to the master process:
+    SIGHUP              restart all workers gracefully, one after another.
+    SIGTERM, SIGINT     stop all workers gracefully, then exit.
+'''
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import logging
+
+from tornado.ioloop import IOLoop
+from tornado.process import cpu_count
+
+EXIT_RESTART = 3    # exit status of a worker asking the master to fork a new one
+
+logger = logging.getLogger('tornado.general')
+
+
+class WorkerStats():
+    '''Stats of the current (worker) process.'''
+    def __init__(self):
+        self.task_id = None     # None if not running in a forked worker
+        self.started = time.time()
+        self.requests = 0
+        self.in_flight = 0
+        self.status_codes = {}
+        self.exit_code = 0
+
+    def request_started(self):
+        self.requests += 1
+        self.in_flight += 1
+
+    def request_finished(self, status_code):
+        self.in_flight -= 1
+        self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+    def as_dict(self):
+        return {
+            'pid': os.getpid(),
+            'task_id': self.task_id,
+            'uptime': round(time.time() - self.started, 3),
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'status_codes': dict((str(k), v) for k, v in self.status_codes.items())
+        }
+
+stats = WorkerStats()
+
+
+def fork_workers(num_processes, max_restarts=100):
+    '''Fork num_processes workers (one per CPU if num_processes <= 0), and
+       return the task id (0 to num_processes - 1) in each worker.
+
+       The master process never returns. It restarts workers exiting with
+       an error (up to max_restarts times) or with EXIT_RESTART, and exits
+       when all workers have exited normally. Like fork_processes, this must
+       be called before any IOLoop is created.
+    '''
+    if num_processes is None or num_processes <= 0:
+        num_processes = cpu_count()
+    if IOLoop.initialized():
+        raise RuntimeError("Cannot fork workers after the IOLoop is initialized.")
+    logger.info("Starting %d worker processes", num_processes)
+    children = {}    # pid --> task id
+
+    def forward_signal(signum, frame):
+        # SIGHUP is passed as is (restart), others as SIGTERM (shutdown).
+        sig = signal.SIGHUP if signum == signal.SIGHUP else signal.SIGTERM
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def start_child(i):
+        pid = os.fork()
+        if pid == 0:
+            # child process
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            random.seed()
+            stats.task_id = i
+            stats.started = time.time()
+            return i
+        else:
+            children[pid] = i
+            return None
+
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, forward_signal)
+    for i in range(num_processes):
+        task_id = start_child(i)
+        if task_id is not None:
+            return task_id
+
+    num_restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        task_id = children.pop(pid)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == EXIT_RESTART:
+            logger.info("worker %d (pid %d) restarting", task_id, pid)
+        elif os.WIFSIGNALED(status):
+            logger.warning("worker %d (pid %d) killed by signal %d, restarting",
+                           task_id, pid, os.WTERMSIG(status))
+            num_restarts += 1
+        elif os.WEXITSTATUS(status) != 0:
+            logger.warning("worker %d (pid %d) exited with status %d, restarting",
+                           task_id, pid, os.WEXITSTATUS(status))
+            num_restarts += 1
+        else:
+            logger.info("worker %d (pid %d) exited normally", task_id, pid)
+            continue
+        if num_restarts > max_restarts:
+            raise RuntimeError("Too many worker restarts, giving up")
+        new_id = start_child(task_id)
+        if new_id is not None:
+            return new_id
+    sys.exit(0)
+
+
+def install_graceful_shutdown(http_server, timeout=30, stagger=2):
+    '''In a worker, on SIGTERM or SIGINT, stop accepting new connections, wait
+       for the in-flight requests to finish (at most timeout seconds), then
+       stop the IOLoop. SIGHUP does the same, but sets stats.exit_code to
+       EXIT_RESTART, so the master forks a new worker. Workers are restarted
+       stagger seconds apart, so the others keep serving in the meantime.
+    '''
+    io_loop = IOLoop.current()
+
+    def shutdown(restart):
+        def stop_when_idle(deadline):
+            if stats.in_flight <= 0 or time.time() > deadline:
+                stats.exit_code = EXIT_RESTART if restart else 0
+                io_loop.stop()
+            else:
+                io_loop.call_later(0.1, stop_when_idle, deadline)
+
+        def stop():
+            logger.info("worker %s (pid %d) shutting down", stats.task_id, os.getpid())
+            http_server.stop()
+            stop_when_idle(time.time() + timeout)
+
+        delay = (stats.task_id or 0) * stagger if restart else 0
+        io_loop.call_later(delay, stop)
+
+    def handle_signal(signum, frame):
+        io_loop.add_callback_from_signal(shutdown, signum == signal.SIGHUP)
+
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, handle_signal)